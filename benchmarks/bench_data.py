@@ -0,0 +1,42 @@
+# NAME
+#
+#        bench_data
+#
+# DESCRIPTION
+#
+#        Synthetic volumes shared by the benchmarks, used when no NIfTI
+#        file is given. Both are seeded, so every run (and every
+#        benchmark) sees the same data.
+#
+
+import numpy as np
+
+
+def synthetic_label(size, labels=8):
+    '''
+    Nearest-seed regions (a Voronoi partition) of <labels> labels, with
+    a label 0 background outside a sphere.
+    '''
+    rng     = np.random.default_rng(0)
+    seeds   = rng.uniform(0, size, (64, 3))
+    grid    = np.indices((size,) * 3).reshape(3, -1).T
+    volume  = np.empty(len(grid), dtype=np.uint8)
+    for start in range(0, len(grid), 1 << 20):
+        chunk = grid[start:start + (1 << 20)]
+        d2    = ((chunk[:, None, :] - seeds[None, :, :]) ** 2).sum(axis=2)
+        volume[start:start + len(chunk)] = 1 + d2.argmin(axis=1) % (labels - 1)
+    volume  = volume.reshape((size,) * 3)
+    volume[((np.indices((size,) * 3) - size / 2.) ** 2).sum(axis=0) > (size / 2.) ** 2] = 0
+    return volume
+
+
+def synthetic_gray(size):
+    '''
+    A smooth uint8 phantom with noise, zero outside a sphere.
+    '''
+    rng     = np.random.default_rng(0)
+    x       = np.linspace(-1, 1, size)
+    X, Y, Z = np.meshgrid(x, x, x, indexing='ij')
+    volume  = 120 + 60 * np.sin(4 * X) * np.cos(3 * Y) + 30 * Z + rng.normal(0, 8, X.shape)
+    volume[X ** 2 + Y ** 2 + Z ** 2 > 1] = 0
+    return np.clip(volume, 0, 255).astype(np.uint8)
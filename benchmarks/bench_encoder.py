@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+#
+# NAME
+#
+#        bench_encoder
+#
+# DESCRIPTION
+#
+#        Reports, for every encoder preset, the encode time and the
+#        encoded size per slice of a label volume (rendered through the
+#        colormap label table, as Projecao Segmentada Fases, both as RGBA
+#        and as palette images) and of a grayscale volume (rendered as
+#        Projecao Tomografica), as PNG and as lossless and lossy WebP.
+#
+#        Synthetic volumes are used unless NIfTI files are given:
+#
+#        python benchmarks/bench_encoder.py --label seg.nii --gray ct.nii
+#        python benchmarks/bench_encoder.py --formats png,webp
+#
+
+import io
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import nibabel as nib
+import matplotlib.cm as cm
+from PIL import Image
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..'))
+from med2image import renderer
+from med2image.encoder import Encoder, PRESETS
+from med2image.color_map import createColorDict
+from bench_data import synthetic_label, synthetic_gray
+
+COLORMAP = os.path.join(os.path.dirname(__file__), '..', 'colormaps', 'default_colormap.txt')
+
+
+def slices_render(volume, kind):
+    '''
+    Renders every z slice of <volume> as a PIL image, as the output
+    mode <kind> ('label', 'indexed' or 'gray') would.
+    '''
+    lut = renderer.label_lut(list(createColorDict(COLORMAP).values()))
+    l_img = []
+    for i in range(volume.shape[2]):
+        Mnp_slice = np.ascontiguousarray(volume[:, :, i])
+        if kind == 'indexed':
+            Mnp_index, Mnp_palette = renderer.label_index(lut, Mnp_slice)
+            img = renderer.indexed_image(Mnp_index, Mnp_palette)
+        elif kind == 'label':
+            img = Image.fromarray(renderer.label_apply(lut, Mnp_slice), 'RGBA')
+        else:
+            img = Image.fromarray(renderer.render(cm.Greys_r, Mnp_slice, backgroundPixel=(1, 1)), 'RGBA')
+        l_img.append(img)
+    return l_img
+
+
+# output formats: (PIL format, Encoder settings)
+FORMATS = {
+    'png':          ('png', {}),
+    'webp':         ('webp', {}),
+    'webp-lossy':   ('webp', {'webpLossless': False}),
+}
+
+
+def bench(l_img, encoder, fformat):
+    nbytes  = 0
+    tic     = time.perf_counter()
+    for img in l_img:
+        buf = io.BytesIO()
+        encoder.save(img, buf, fformat)
+        nbytes += buf.tell()
+    return (time.perf_counter() - tic) * 1000. / len(l_img), nbytes / len(l_img)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="encoder preset benchmark")
+    parser.add_argument('--label', help="label NIfTI volume (default: synthetic)")
+    parser.add_argument('--gray', help="grayscale NIfTI volume (default: synthetic)")
+    parser.add_argument('--size', type=int, default=256, help="edge of the synthetic volumes")
+    parser.add_argument('--formats', default=','.join(FORMATS),
+                        help="comma separated output formats, of: %s" % ', '.join(FORMATS))
+    args = parser.parse_args()
+    l_format = args.formats.split(',')
+
+    for kind, str_file, synthetic in [('label', args.label, synthetic_label),
+                                      ('indexed', args.label, synthetic_label),
+                                      ('gray', args.gray, synthetic_gray)]:
+        if str_file:
+            volume = np.asanyarray(nib.load(str_file).dataobj)
+        else:
+            volume = synthetic(args.size)
+        tic     = time.perf_counter()
+        l_img   = slices_render(volume, kind)
+        print('%s volume %s (%d slices, rendered in %.2f ms/slice)' % (
+              kind, 'x'.join(map(str, volume.shape)), len(l_img),
+              (time.perf_counter() - tic) * 1000. / len(l_img)))
+        for str_format in l_format:
+            if kind == 'indexed' and str_format != 'png':
+                # palette images are a PNG output mode
+                continue
+            fformat, d_settings = FORMATS[str_format]
+            for preset in PRESETS:
+                ms, nbytes = bench(l_img, Encoder(preset, **d_settings), fformat)
+                print('    %-10s %-8s %8.2f ms/slice %10.0f bytes/slice' % (
+                      str_format, preset, ms, nbytes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+#
+# NAME
+#
+#        bench_jobs
+#
+# DESCRIPTION
+#
+#        Measures the slice throughput of a resliced NIfTI conversion
+#        rendered with an increasing number of processes (--jobs) and of
+#        encoder threads (--writeJobs), and checks that every run writes
+#        the same files as the serial one.
+#
+#        A synthetic grayscale volume is used unless a NIfTI file is
+#        given:
+#
+#        python benchmarks/bench_jobs.py --jobs 1,2,4,8,16,32
+#        python benchmarks/bench_jobs.py --jobs 1,4 --writeJobs 0,2
+#        python benchmarks/bench_jobs.py --input ct.nii --type Projecao_Tomografica
+#
+
+import os
+import sys
+import time
+import shutil
+import filecmp
+import argparse
+import tempfile
+
+import numpy as np
+import nibabel as nib
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..'))
+from med2image import med2image
+from bench_data import synthetic_gray
+
+COLORMAP = os.path.join(os.path.dirname(__file__), '..', 'colormaps', 'default_colormap.txt')
+
+
+def convert(str_input, str_outputDir, str_type, jobs, writeJobs):
+    C_convert = med2image.med2image_nii(inputFile=str_input, outputDir=str_outputDir,
+                                        outputFileStem='output', outputFileType='png',
+                                        sliceToConvert='-1', frameToConvert='-1', reslice=True,
+                                        segmentationType=str_type, colorTxt=COLORMAP,
+                                        jobs=jobs, writeJobs=writeJobs)
+    C_convert._log.syslog(False)
+    C_convert._log.to(open(os.devnull, 'w'))
+    tic = time.perf_counter()
+    C_convert.run()
+    return time.perf_counter() - tic, sum(C_convert._Vnp_3DVol.shape)
+
+
+def same_tree(str_a, str_b):
+    cmp = filecmp.dircmp(str_a, str_b)
+    if cmp.left_only or cmp.right_only or cmp.funny_files:
+        return False
+    if filecmp.cmpfiles(str_a, str_b, cmp.common_files, shallow=False)[1:] != ([], []):
+        return False
+    return all(same_tree(os.path.join(str_a, d), os.path.join(str_b, d)) for d in cmp.common_dirs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="parallel rendering benchmark")
+    parser.add_argument('--input', help="NIfTI volume (default: synthetic)")
+    parser.add_argument('--type', default='Projecao_Tomografica', help="segmentation type")
+    parser.add_argument('--size', type=int, default=256, help="edge of the synthetic volume")
+    parser.add_argument('--jobs', default='1,2,4', help="comma separated process counts")
+    parser.add_argument('--writeJobs', default='0', help="comma separated encoder thread counts")
+    args = parser.parse_args()
+
+    str_tmp = tempfile.mkdtemp(prefix='bench_jobs')
+    try:
+        str_input = args.input
+        if not str_input:
+            str_input = os.path.join(str_tmp, 'volume.nii')
+            nib.save(nib.Nifti1Image(synthetic_gray(args.size), np.eye(4)), str_input)
+        str_serial = None
+        for jobs in [int(j) for j in args.jobs.split(',')]:
+            for writeJobs in [int(w) for w in args.writeJobs.split(',')]:
+                str_outputDir   = os.path.join(str_tmp, 'jobs%d-write%d' % (jobs, writeJobs))
+                seconds, slices = convert(str_input, str_outputDir, args.type, jobs, writeJobs)
+                if str_serial is None:
+                    str_serial  = str_outputDir
+                print('    jobs %3d writeJobs %3d: %8.1f slices/s %s' % (
+                      jobs, writeJobs, slices / seconds,
+                      '' if same_tree(str_serial, str_outputDir) else '(OUTPUT DIFFERS)'))
+    finally:
+        shutil.rmtree(str_tmp)
+
+
+if __name__ == '__main__':
+    main()
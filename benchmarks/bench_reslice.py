@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+#
+# NAME
+#
+#        bench_reslice
+#
+# DESCRIPTION
+#
+#        Measures x/y/z slice throughput of 'dim_save' style reslicing,
+#        with slices taken as strided views of the volume versus from
+#        the per-axis contiguous layout built by axis_contiguous().
+#
+#        Each slice is consumed the way a renderer does, by mapping every
+#        voxel through a lookup table.
+#
+#        python benchmarks/bench_reslice.py --size 512 --dtype uint16
+#
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..'))
+from med2image.volume import axis_contiguous
+
+
+LUT = np.arange(1 << 16, dtype=np.uint32)
+
+
+def consume(Mnp_slice):
+    return LUT[Mnp_slice]
+
+
+def bench_strided(volume, axis):
+    tic = time.perf_counter()
+    for i in range(volume.shape[axis]):
+        consume(volume[(slice(None),) * axis + (i,)])
+    return time.perf_counter() - tic
+
+
+def bench_contiguous(volume, axis):
+    tic = time.perf_counter()
+    Vnp_axis = axis_contiguous(volume, axis)
+    toc = time.perf_counter()
+    for i in range(Vnp_axis.shape[0]):
+        consume(Vnp_axis[i])
+    return toc - tic, time.perf_counter() - toc
+
+
+def main():
+    parser = argparse.ArgumentParser(description="reslice throughput benchmark")
+    parser.add_argument('--size', type=int, default=512, help="edge of the cubic test volume")
+    parser.add_argument('--dtype', default='uint16', help="voxel type")
+    args = parser.parse_args()
+
+    shape = (args.size,) * 3
+    for order, str_layout in [('F', 'NIfTI (Fortran order)'), ('C', 'DICOM (C order)')]:
+        volume = np.asarray(np.random.default_rng(0).integers(0, 255, shape),
+                            dtype=args.dtype, order=order)
+        volume = volume.astype(volume.dtype, order=order)
+        print('%s volume %s %s' % (str_layout, 'x'.join(map(str, shape)), args.dtype))
+        for axis, str_dim in enumerate('xyz'):
+            t_strided               = bench_strided(volume, axis)
+            t_layout, t_contiguous  = bench_contiguous(volume, axis)
+            print('    %s: strided %8.1f slices/s    contiguous %8.1f slices/s (+ %.3f s layout)' % (
+                  str_dim, shape[axis] / t_strided, shape[axis] / t_contiguous, t_layout))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+# NAME
+#
+#        atlas
+#
+# DESCRIPTION
+#
+#        Sprite-sheet (atlas) output for med2image.
+#
+#        Instead of one file per slice, the slices of an axis are pasted
+#        into grid sprite sheets of up to <slicesPerSheet> slices each,
+#        held in memory until full. Next to the sheets, an index file
+#        (atlas.json) records the slice size, the grid and the sheet and
+#        offset of every slice:
+#
+#          {
+#            "total": 30, "sliceWidth": 40, "sliceHeight": 36,
+#            "columns": 6, "rows": 5, "slicesPerSheet": 30,
+#            "sheets": ["image-atlas000.png"],
+#            "slices": [{"index": 0, "sheet": 0, "x": 0, "y": 0}, ...]
+#          }
+#
+#        "total" takes over the role of total.txt.
+#
+
+# System imports
+import os
+import json
+import math
+
+# System dependency imports
+from PIL import Image
+
+ATLAS_INDEX = 'atlas.json'
+
+
+class Atlas(object):
+    '''
+    Packs the slice images of one axis into sprite sheets written in
+    <str_outputDir> as <str_stem>-atlasNNN.<fformat>. <save>(image,
+    path) encodes a sheet.
+    '''
+
+    def __init__(self, str_outputDir, str_stem, fformat, slicesPerSheet, save):
+        self._str_outputDir     = str_outputDir
+        self._str_stem          = str_stem
+        self._fformat           = fformat
+        self._save              = save
+        self.slicesPerSheet     = int(slicesPerSheet)
+        self.columns            = int(math.ceil(math.sqrt(self.slicesPerSheet)))
+        self.rows               = int(math.ceil(self.slicesPerSheet / float(self.columns)))
+        self.size               = None  # (width, height) of the slices
+        self._canvas            = None
+        self._count             = 0     # slices on the current sheet
+        self.l_sheet            = []
+        self.l_slice            = []
+
+    def sheet_name(self, sheet):
+        return '%s-atlas%03d.%s' % (self._str_stem, sheet, self._fformat)
+
+    def add(self, index, img):
+        '''
+        Pastes <img>, the image of slice <index>, into the next cell of
+        the current sheet, writing the sheet out when it is full.
+        '''
+        if self.size is None:
+            self.size = img.size
+        elif img.size != self.size:
+            raise ValueError('slice %d is %dx%d, the atlas holds %dx%d slices' %
+                             (index, img.size[0], img.size[1], self.size[0], self.size[1]))
+        if self._canvas is None:
+            width, height = self.size
+            if img.mode == 'RGB':
+                # formats without alpha: the slices are composited over white
+                self._canvas = Image.new('RGB', (self.columns * width, self.rows * height), (255, 255, 255))
+            else:
+                self._canvas = Image.new('RGBA', (self.columns * width, self.rows * height), (0, 0, 0, 0))
+        x = (self._count % self.columns) * self.size[0]
+        y = (self._count // self.columns) * self.size[1]
+        self._canvas.paste(img.convert(self._canvas.mode), (x, y))
+        self.l_slice.append({'index': index, 'sheet': len(self.l_sheet), 'x': x, 'y': y})
+        self._count += 1
+        if self._count == self.slicesPerSheet:
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes out the current sheet, cropped to the rows in use.
+        '''
+        if not self._count:
+            return
+        rows            = int(math.ceil(self._count / float(self.columns)))
+        canvas          = self._canvas
+        if rows < self.rows:
+            canvas = canvas.crop((0, 0, canvas.size[0], rows * self.size[1]))
+        str_sheet       = self.sheet_name(len(self.l_sheet))
+        self._save(canvas, os.path.join(self._str_outputDir, str_sheet))
+        self.l_sheet.append(str_sheet)
+        self._canvas    = None
+        self._count     = 0
+
+    def close(self):
+        '''
+        Writes out the last sheet and the index. Returns the index path.
+        '''
+        self.flush()
+        width, height = self.size if self.size else (0, 0)
+        d_index = {
+            'total':            len(self.l_slice),
+            'sliceWidth':       width,
+            'sliceHeight':      height,
+            'columns':          self.columns,
+            'rows':             self.rows,
+            'slicesPerSheet':   self.slicesPerSheet,
+            'sheets':           self.l_sheet,
+            'slices':           self.l_slice,
+        }
+        str_index = os.path.join(self._str_outputDir, ATLAS_INDEX)
+        with open(str_index, 'w') as f:
+            json.dump(d_index, f, indent=1)
+        return str_index
@@ -0,0 +1,120 @@
+# NAME
+#
+#        encoder
+#
+# DESCRIPTION
+#
+#        Image encoding policy for med2image. Rendered slices are handed
+#        to an Encoder, which writes them with the compression settings
+#        of a preset:
+#
+#          o fast       PNG: zlib level 1, the cheapest encode that still
+#                       compresses; WebP: method 0;
+#          o balanced   PNG: zlib level 6 and PIL's strategy (PIL's
+#                       defaults); WebP: method 4;
+#          o small      PNG: zlib level 9 with zlib's default strategy,
+#                       which beats PIL's on noisy grayscale slices, and
+#                       PIL's optimize pass; WebP: method 5 (method 6
+#                       lossless is often 50-100x slower for a few
+#                       percent).
+#
+#        Each setting can also be overridden on its own. PIL does not let
+#        the PNG row filter be chosen, so the "strategy" is the zlib
+#        strategy the filtered rows are compressed with.
+#
+#        WebP is written lossless by default, keeping the exact colors
+#        of transparent pixels as PNG does, or lossy at 'webpQuality'.
+#
+
+# System imports
+import zlib
+
+# zlib strategies, by name. 'default' leaves the choice to PIL (which
+# then compresses as with Z_FILTERED); 'deflate' is zlib's own default.
+PNG_STRATEGIES = {
+    'default':  -1,
+    'deflate':  zlib.Z_DEFAULT_STRATEGY,
+    'filtered': zlib.Z_FILTERED,
+    'huffman':  zlib.Z_HUFFMAN_ONLY,
+    'rle':      zlib.Z_RLE,
+    'fixed':    zlib.Z_FIXED,
+}
+
+PRESETS = {
+    'fast':     {'compressLevel': 1, 'pngStrategy': 'deflate', 'optimize': False,
+                 'webpMethod': 0, 'webpLossless': True, 'webpQuality': 90},
+    'balanced': {'compressLevel': 6, 'pngStrategy': 'default', 'optimize': False,
+                 'webpMethod': 4, 'webpLossless': True, 'webpQuality': 90},
+    'small':    {'compressLevel': 9, 'pngStrategy': 'deflate', 'optimize': True,
+                 'webpMethod': 5, 'webpLossless': True, 'webpQuality': 90},
+}
+
+# Effort ("quality" to libwebp) of lossless WebP, for each method.
+WEBP_LOSSLESS_EFFORT = [0, 25, 50, 75, 75, 90, 100]
+
+
+class Encoder(object):
+    '''
+    Writes PIL images to files with the settings of a preset (see the
+    module description), optionally overridden by the 'compressLevel'
+    (0-9), 'pngStrategy' (a key of PNG_STRATEGIES), 'optimize',
+    'webpMethod' (0-6), 'webpLossless' or 'webpQuality' (0-100, lossy
+    WebP only) kwargs. A value of None keeps the preset's setting.
+    '''
+
+    def __init__(self, preset='balanced', **kwargs):
+        if preset not in PRESETS:
+            raise ValueError('unknown encoder preset %s' % preset)
+        self.preset         = preset
+        d_settings          = dict(PRESETS[preset])
+        for key, value in kwargs.items():
+            if key in d_settings and value is not None:
+                d_settings[key] = value
+        self.compressLevel  = int(d_settings['compressLevel'])
+        self.pngStrategy    = d_settings['pngStrategy']
+        self.optimize       = bool(d_settings['optimize'])
+        self.webpMethod     = int(d_settings['webpMethod'])
+        self.webpLossless   = bool(d_settings['webpLossless'])
+        self.webpQuality    = int(d_settings['webpQuality'])
+        if not 0 <= self.compressLevel <= 9:
+            raise ValueError('compression level must be within 0-9, got %d' % self.compressLevel)
+        if self.pngStrategy not in PNG_STRATEGIES:
+            raise ValueError('unknown PNG strategy %s' % self.pngStrategy)
+        if not 0 <= self.webpMethod <= 6:
+            raise ValueError('WebP method must be within 0-6, got %d' % self.webpMethod)
+        if not 0 <= self.webpQuality <= 100:
+            raise ValueError('WebP quality must be within 0-100, got %d' % self.webpQuality)
+
+    def params(self):
+        '''
+        The settings that determine the encoded bytes.
+        '''
+        return (self.compressLevel, self.pngStrategy, self.optimize,
+                self.webpMethod, self.webpLossless, self.webpQuality)
+
+    def options(self, fformat):
+        '''
+        PIL save() options for format <fformat>.
+        '''
+        if fformat == 'png':
+            return {'compress_level':   self.compressLevel,
+                    'compress_type':    PNG_STRATEGIES[self.pngStrategy],
+                    'optimize':         self.optimize}
+        if fformat == 'webp':
+            if self.webpLossless:
+                return {'lossless':     True,
+                        'quality':      WEBP_LOSSLESS_EFFORT[self.webpMethod],
+                        'method':       self.webpMethod,
+                        'exact':        True}
+            return {'lossless':         False,
+                    'quality':          self.webpQuality,
+                    'method':           self.webpMethod,
+                    'alpha_quality':    100}
+        return {}
+
+    def save(self, img, astr_outputFile, fformat):
+        '''
+        Encodes the PIL image <img> into <astr_outputFile> as <fformat>
+        (a PIL format name, lower case).
+        '''
+        img.save(astr_outputFile, fformat, **self.options(fformat))
@@ -15,26 +15,37 @@
 
 # System imports
 import os
+import sys
 import glob
+import concurrent.futures
+import multiprocessing
+import copy
+import itertools
 import numpy as np
 import re
 
 # System dependency imports
 import nibabel as nib
 import pydicom
-import pylab
 import matplotlib.cm as cm
 from matplotlib.colors import LinearSegmentedColormap, ListedColormap
 # Project specific imports
 from . import error
 from . import message as msg
 from . import systemMisc as misc
+from . import renderer
+from . import pyramid
+from .atlas import Atlas
 from .color_map import createColorDict
+from .volume import LazyVolume, ChunkedVolume, axis_contiguous, slice_orient
+from .nifti_io import nifti_load
+from .render_cache import RenderCache, file_link
+from .encoder import Encoder
+from .writer import SliceWriter
 from math import ceil
 import math
-import numpy
 import collections
-from PIL import Image
+from pydicom.uid import ExplicitVRLittleEndian
 
 class med2image(object):
     """
@@ -57,6 +68,10 @@ class med2image(object):
             'action'        : 'attempting insert DICOM into volume structure, ',
             'error'         : 'a dimension mismatch occurred. This DICOM file is of different image size to the rest.',
             'exitCode'      : 20},
+        'dcmSeriesInconsistent': {
+            'action'        : 'attempting to scan DICOM series headers, ',
+            'error'         : 'this DICOM file does not match the image geometry or pixel format of the rest of the series.',
+            'exitCode'      : 20},
         'ProtocolNameTag': {
             'action'        : 'attempting to parse DICOM header, ',
             'error'         : 'the DICOM file does not seem to contain a ProtocolName tag.',
@@ -90,6 +105,9 @@ class med2image(object):
     SEG_PORE_LABELED = 'Projecao Segmentada Pore Labeled'
     SEG_MINERALS = 'Projecao Segmentada Minerais'
     COLORED_TYPES = [SEG_PHASES, SEG_PORE_LABELED, SEG_MINERALS]
+    BLUE_PORE_COLOR = (0, 0.972, 0.915, 1) # cor azul claro dos poros (SEG_PORE)
+    GRAY_COLORMAP_CACHE = 8 # colormaps cinza mantidos (por valor maximo do slice)
+    RENDER_TASKS_PER_JOB = 4 # faixas de slices por processo, para balancear a carga
     SEGMENTED =  COLORED_TYPES + [SEG_PORE]
     NON_COLORED_TYPES = [NON_SEGMENTED, SEG_PORE]
 
@@ -174,7 +192,7 @@ class med2image(object):
         self._Vnp_3DVol                 = None
         self._Mnp_2Dslice               = None
         self._dcm                       = None
-        self._dcmList                   = []
+        self._dcmList                   = [] # per-slice DICOM headers, without pixel data
 
         # A logger
         self._log                       = msg.Message()
@@ -185,11 +203,33 @@ class med2image(object):
         self._b_convertMiddleSlice      = False
         self._b_convertMiddleFrame      = False
         self._b_reslice                 = False
+        self._b_lazy                    = False # read slices on demand instead of loading the volume
+        self._str_sliceDim              = 'z'   # axis of the slice being saved
+        self._b_flipSlice               = False # slices of the axis being saved are flipped top to bottom
+        self._readJobs                  = 1     # parallel workers used to read a DICOM series
+        self._renderJobs                = 1     # processes used to render the slices
+        self._writeJobs                 = 0     # threads encoding and writing the slices (0: none)
+        self._writer                    = None  # SliceWriter of the slices being rendered
+        self._str_niftiCache            = ''    # where to keep decompressed copies of .nii.gz input
+        self._memoryBudget              = 0     # bytes of volume bricks to keep resident (0: no limit)
+        self._renderCache               = None  # persistent cache of rendered slices
+        self._b_dedupSlices             = False # link identical slices to one rendered file
+        self._str_encoderPreset         = 'balanced' # image compression preset (see encoder.py)
+        self._d_encoderSettings         = {}    # settings overriding the preset
+        self._str_colorMode             = 'rgba' # pixel format of the output images
+        self._b_tiles                   = False # also write a DeepZoom tile pyramid of each slice
+        self._tileSize                  = 256
+        self._atlasSlices               = 0     # slices per sprite sheet (0: one file per slice)
+        self._d_renderedSlice           = {}    # slice fingerprint -> first file rendered for it
+        self._dedupCount                = 0
+        self._str_colorTxtContents      = None
         self.func                       = None #transformation function
 
         #Custom attributes for colored segmentations
         self.segmentationType           = None # to check if is colored
         self.colorTxt                   = None # to customize colormap
+        self._Mnp_labelLut              = None # label -> RGBA table compiled from the colormap
+        self._d_grayColormap            = collections.OrderedDict() # slice max -> gray colormap
         self.blueLimit                  = 60   # to customize grayscale with blue spots
         self.minBlueLimit               = 0    # to customize grayscale with blue spots (HARDCODED!)
         # self.maxMatrixValue             = None # can represent the number of phases (SEG_MINERALS/SEG_PHASES) or simply
@@ -208,10 +248,28 @@ class med2image(object):
             if key == "frameToConvert":     self._str_frameToConvert    = value
             if key == "showSlices":         self._b_showSlices          = value
             if key == 'reslice':            self._b_reslice             = value
+            if key == 'lazy':               self._b_lazy                = value
+            if key == 'readJobs':           self._readJobs              = int(value)
+            if key == 'jobs':               self._renderJobs            = int(value)
+            if key == 'writeJobs':          self._writeJobs             = int(value or 0)
+            if key == 'niftiCache':         self._str_niftiCache        = value
+            if key == 'memoryBudget':       self._memoryBudget          = int(float(value) * 1024 * 1024) # MB
+            if key == 'renderCache' and value: self._renderCache        = RenderCache(value)
+            if key == 'dedupSlices':        self._b_dedupSlices         = value
+            if key == 'encoderPreset' and value: self._str_encoderPreset = value
+            if key == 'colorMode' and value: self._str_colorMode    = value
+            if key == 'tiles':              self._b_tiles               = value
+            if key == 'tileSize':           self._tileSize              = int(value)
+            if key == 'atlas':              self._atlasSlices           = int(value or 0)
+            if key in ['compressLevel', 'pngStrategy', 'optimize',
+                       'webpMethod', 'webpLossless', 'webpQuality']:
+                                            self._d_encoderSettings[key] = value
             if key == 'segmentationType':   self.segmentationType       = value.replace('_',' ') # recebe Projecao_Segmentada_Fases mas testa Projecao Segmentada Fases
             if key == 'colorTxt':           self.colorTxt               = value # path/to/colormap.txt
             if key == 'blueLimit':          self.blueLimit              = int(value) # valor limite para definir poro como azul
 
+        self._encoder = Encoder(self._str_encoderPreset, **self._d_encoderSettings)
+
         if self._str_frameToConvert.lower() == 'm':
             self._b_convertMiddleFrame = True
         elif len(self._str_frameToConvert):
@@ -300,6 +358,42 @@ class med2image(object):
         return str_outputFile
 
     def dim_save(self, **kwargs):
+        '''
+        Saves the slices of one axis of the volume (see dim_prepare() for
+        the kwargs). With <jobs> > 1 the slices are rendered by a pool of
+        processes.
+        '''
+        self.dims_save([kwargs])
+
+    def dims_save(self, l_dims):
+        '''
+        Saves the slices of several axes of the volume, <l_dims> being the
+        dim_save() kwargs of each. With <jobs> > 1 all the axes are set up
+        first and their slices rendered together by one pool of processes,
+        so that a short axis does not leave workers idle.
+        '''
+        if self._renderJobs <= 1:
+            l_axis = []
+            for kwargs in l_dims:
+                l_axis.append(self.dim_prepare(**kwargs))
+                self.dim_render_serial(l_axis[-1])
+                self.dim_finish(l_axis[-1])
+            return
+        l_axis = [self.dim_prepare(**kwargs) for kwargs in l_dims]
+        if self.render_jobs(max(d['indexStop'] - d['indexStart'] for d in l_axis)) > 1:
+            self.dim_render_parallel(l_axis)
+        else:
+            for d_axis in l_axis:
+                self.dim_render_serial(d_axis)
+        for d_axis in l_axis:
+            self.dim_finish(d_axis)
+
+    def dim_prepare(self, **kwargs):
+        '''
+        Sets up the pass over one axis of the volume: the output
+        subdirectory, the colormap label table and the slice layout.
+        Returns the state of the pass, for dim_render() and dim_finish().
+        '''
         dims            = self._Vnp_3DVol.shape
         self._log('Image volume logical (i, j, k) size: %s\n' % str(dims))
         str_dim         = 'z'
@@ -314,6 +408,9 @@ class med2image(object):
             if key == 'indexStop':  indexStop       = val
             if key == 'rot90':      b_rot90         = val
 
+        # z slices are written flipped top to bottom (except as DICOM)
+        b_flipSlice = b_makeSubDir and str_dim == 'z' and self._str_outputFileType != 'dcm'
+
         str_subDir  = ''
         if b_makeSubDir:
             str_subDir = str_dim
@@ -341,31 +438,8 @@ class med2image(object):
             self.mycolors = list(global_color_dict.values())
             # self.mycolors = getFileColor()
 
-            for i in range(0, dims[dim_ix['z']]):
-                self.slice_number = i
-                self._Mnp_2Dslice = self._Vnp_3DVol[:, :, i]
-
-                slice_keys = numpy.unique(self._Mnp_2Dslice)
-
-                for key in slice_keys:
-                    if not key in self.d:
-                        self.d[key] = []
-                    self.d[key].append(self.slice_number)
-
-            color_dict = {}
-            for k,v in self.d.items():
-                if k > 6 :
-                    break
-                #print ("pore: ", k,  "len slices: ", len(v), " slices: ", v)
-
-            global_colors = list(global_color_dict.values())
-
-            if global_color_dict[0] == (0,0, 0, 0):
-                transparency, global_colors = global_colors[:1], global_colors[1:]
-            else:
-                transparency = []
-            num_colors =  len(global_colors)
-            num_phases = len(self.d.items())
+            # tabela fixa rotulo -> RGBA, compilada uma vez por volume
+            self._Mnp_labelLut = renderer.label_lut(self.mycolors)
 
             # self.mycolors = transparency + list( global_colors * math.ceil( float(num_phases)/num_colors))[:num_phases] # DEPRECATED?
 
@@ -374,7 +448,6 @@ class med2image(object):
             '''
             print ("The original colormap has len =  ", num_colors)
             print ("The original colormap is =  ", transparency, global_colors)
-            print ("The # of phases in the input =   ", num_phases)
             print ("The extended color map has len = ", len(self.mycolors))
             '''
             # print( '[355] self.mycm(0)',self.mycm(0))
@@ -386,49 +459,302 @@ class med2image(object):
             # print( 'self.mycm(6)',self.mycm(6))
             # print( 'np.unique(self._Vnp_3DVol)',np.unique(self._Vnp_3DVol))
 
+        # An in-memory volume is re-laid out once per axis so that every
+        # slice handed to the renderer is contiguous, instead of being a
+        # strided view spread across the whole volume.
+        Vnp_axis = None
+        if isinstance(self._Vnp_3DVol, np.ndarray) and indexStop - indexStart > 1:
+            Vnp_axis = axis_contiguous(self._Vnp_3DVol, dim_ix[str_dim])
+            # the orientation of this axis is applied once, as a view of all its slices
+            Vnp_axis = slice_orient(Vnp_axis, b_rot90, b_flipSlice)
+
+        # Sprite sheets: the slices of this axis are pasted into shared
+        # in-memory canvases instead of being written one file each.
+        atlas = None
+        if self._atlasSlices and self._str_outputFileType != 'dcm':
+            fformat = self._str_outputFileType.lstrip('.')
+            atlas   = Atlas('%s/%s' % (self._str_outputDir, str_subDir), self._str_outputFileStem,
+                            fformat, self._atlasSlices,
+                            lambda sheet, str_sheetFile: self.image_output(sheet, str_sheetFile, fformat))
+
+        return {
+            'dimension':    str_dim,
+            'subDir':       str_subDir,
+            'rot90':        b_rot90,
+            'flipSlice':    b_flipSlice,
+            'indexStart':   indexStart,
+            'indexStop':    indexStop,
+            'slicePixels':  int(np.prod(dims)) // max(1, dims[dim_ix[str_dim]]),
+            'volume':       Vnp_axis,
+            'atlas':        atlas,
+            # slices of this pass deduplicated, restored from and added to the render cache
+            'dedupCount':   0,
+            'cacheHits':    0,
+            'cacheMisses':  0,
+        }
+
+    def dim_render_serial(self, d_axis):
+        '''
+        Renders all the slices of the axis pass <d_axis>, in this process.
+        '''
+        atlas = d_axis['atlas']
+        self.dim_count(d_axis, self.dim_render(d_axis, d_axis['indexStart'], d_axis['indexStop'],
+                                               atlas.add if atlas is not None else None))
+
+    def dim_count(self, d_axis, counts):
+        '''
+        Adds the (deduplicated, cache hits, cache misses) <counts> of a
+        slice range to the axis pass <d_axis>.
+        '''
+        dedupCount, cacheHits, cacheMisses = counts
+        d_axis['dedupCount']    += dedupCount
+        d_axis['cacheHits']     += cacheHits
+        d_axis['cacheMisses']   += cacheMisses
+
+    def dim_render(self, d_axis, indexStart, indexStop, add=None):
+        '''
+        Renders slices <indexStart> to <indexStop> (exclusive) of the
+        axis pass <d_axis> into their output files or, given <add>, hands
+        each rendered image to add(index, image) instead (an atlas).
+        Returns the number of slices deduplicated, restored from the
+        render cache and missing from it.
+        '''
+        dedupCount          = self._dedupCount
+        if self._renderCache is not None:
+            cacheHits, cacheMisses = self._renderCache.hits, self._renderCache.misses
+        self._str_sliceDim  = d_axis['dimension']
+        self._b_flipSlice   = d_axis['flipSlice']
+        fformat             = self._str_outputFileType.lstrip('.')
+        if self._writeJobs > 0:
+            # (created here, so that every forked render worker has its own)
+            self._writer    = SliceWriter(self._writeJobs)
+        try:
+            self.dim_render_slices(d_axis, indexStart, indexStop, add, fformat)
+        finally:
+            if self._writer is not None:
+                writer, self._writer = self._writer, None
+                writer.close()
+        if self._renderCache is None:
+            return self._dedupCount - dedupCount, 0, 0
+        return (self._dedupCount - dedupCount,
+                self._renderCache.hits - cacheHits,
+                self._renderCache.misses - cacheMisses)
+
+    def dim_render_slices(self, d_axis, indexStart, indexStop, add, fformat):
+        '''
+        The rendering loop of dim_render().
+        '''
+        str_dim             = d_axis['dimension']
+        Vnp_axis            = d_axis['volume']
         for i in range(indexStart, indexStop):
         #for i in range(0, 20):
 
             self.slice_number = i
-            if str_dim == 'x':
-                self._Mnp_2Dslice = self._Vnp_3DVol[i, :, :]
-            elif str_dim == 'y':
-                self._Mnp_2Dslice = self._Vnp_3DVol[:, i, :]
+            if Vnp_axis is not None:
+                self._Mnp_2Dslice = Vnp_axis[i]
             else:
-                self._Mnp_2Dslice = self._Vnp_3DVol[:, :, i]
+                if str_dim == 'x':
+                    self._Mnp_2Dslice = self._Vnp_3DVol[i, :, :]
+                elif str_dim == 'y':
+                    self._Mnp_2Dslice = self._Vnp_3DVol[:, i, :]
+                else:
+                    self._Mnp_2Dslice = self._Vnp_3DVol[:, :, i]
+                self._Mnp_2Dslice = slice_orient(self._Mnp_2Dslice, d_axis['rot90'], self._b_flipSlice)
 
-            self.process_slice(b_rot90)
-            str_outputFile = self.get_output_file_name(index=i, subDir=str_subDir)
+            self.process_slice()
+            str_outputFile = self.get_output_file_name(index=i, subDir=d_axis['subDir'])
 
-            self.slice_save(str_outputFile)
+            if add is not None:
+                add(i, self.slice_image(fformat))
+            else:
+                self.slice_output(str_outputFile)
+
+    def render_jobs(self, slices):
+        '''
+        Number of processes to render <slices> slices with.
+        '''
+        if self._renderJobs <= 1 or slices <= 1:
+            return 1
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            # os workers herdam o volume por fork; sem fork, renderiza em serie
+            self._log('Parallel rendering needs fork(), rendering serially\n')
+            self._renderJobs = 1
+            return 1
+        return min(self._renderJobs, slices)
+
+    def dim_render_parallel(self, l_axis):
+        '''
+        Renders the axis passes <l_axis> on a pool of <jobs> forked
+        processes.
+
+        The volume is not copied to the workers: they are forked after
+        the passes are set up, and share the parent's pages (the axis
+        layouts built by dim_prepare() included) copy-on-write. Each
+        task renders a contiguous range of slices of one axis (see
+        render_schedule()) and reports back its deduplication and render
+        cache counts, and, for an atlas, the rendered images, which are
+        placed into the sheets here in slice order.
+        '''
+        global _renderPass
+        jobs    = self.render_jobs(max(d['indexStop'] - d['indexStart'] for d in l_axis))
+        l_task  = render_schedule(l_axis, self.RENDER_TASKS_PER_JOB * jobs)
+        self._log('Rendering %d slices with %d processes\n' % (
+                  sum(stop - start for _, start, stop in l_task), jobs))
+        sys.stdout.flush()
+        _renderPass = (self, l_axis)
+        b_chunked   = isinstance(self._Vnp_3DVol, ChunkedVolume)
+        if b_chunked:
+            # Every worker keeps its own brick cache: the memory budget is
+            # split between them, and the bricks cached here are dropped
+            # before they are forked.
+            self._Vnp_3DVol.resize(self._memoryBudget // jobs)
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers = jobs,
+                                                        mp_context = multiprocessing.get_context('fork')) as executor:
+                # Results come back in task order: a bounded window keeps
+                # the ones finished ahead of a slow task from piling up.
+                results = executor_imap(executor, render_task, l_task, 2 * jobs)
+                try:
+                    for (axis, start, stop), (counts, l_img) in zip(l_task, results):
+                        self.dim_count(l_axis[axis], counts)
+                        self._dedupCount += counts[0]
+                        if self._renderCache is not None:
+                            self._renderCache.hits      += counts[1]
+                            self._renderCache.misses    += counts[2]
+                        for i, img in zip(range(start, stop), l_img):
+                            l_axis[axis]['atlas'].add(i, img)
+                finally:
+                    results.close()
+        finally:
+            _renderPass = None
+            if b_chunked:
+                self._Vnp_3DVol.resize(self._memoryBudget)
+
+    def dim_finish(self, d_axis):
+        '''
+        Completes the axis pass <d_axis>: reports its deduplication and
+        render cache counts and writes total.txt (or the atlas index).
+        '''
+        d_axis['volume'] = None
+        if self._b_dedupSlices:
+            self._log('Deduplicated %d of %d slices\n' % (
+                      d_axis['dedupCount'], max(0, d_axis['indexStop'] - d_axis['indexStart'])))
+        if self._renderCache is not None:
+            self._log('Render cache: %d slices restored, %d rendered\n' % (
+                      d_axis['cacheHits'], d_axis['cacheMisses']))
+
+        fullPathDim = os.path.dirname(self.get_output_file_name(index=0, subDir=d_axis['subDir']))
+        atlas       = d_axis['atlas']
+        if atlas is not None:
+            # o indice do atlas (atlas.json) substitui o total.txt
+            self._log('Atlas index = %s (%d sheets)\n' % (atlas.close(), len(atlas.l_sheet)))
+            totalFilePath = os.path.join(fullPathDim, 'total.txt')
+            if os.path.isfile(totalFilePath):
+                os.remove(totalFilePath)
+            return
 
         # counting number of files in current dim path and storing in total.txt
         try:
-            fullPathDim = os.path.dirname(str_outputFile)
             totalFilePath = os.path.join(fullPathDim,'total.txt')
             if os.path.isfile(totalFilePath):
                 os.remove(totalFilePath)
-            numberOfFiles = len([name for name in os.listdir(fullPathDim) if os.path.isfile(os.path.join(fullPathDim, name))])
+            # (descritores .dzi das piramides de tiles nao sao slices)
+            numberOfFiles = len([name for name in os.listdir(fullPathDim)
+                                 if os.path.isfile(os.path.join(fullPathDim, name)) and not name.endswith('.dzi')])
             f = open(totalFilePath, 'w')
             f.write(str(numberOfFiles))
             f.close
         except Exception as ex:
             print("[dim_save] There was an error generating total.txt ",ex)
 
-    def process_slice(self, b_rot90=None):
+    def process_slice(self):
         '''
         Processes a single slice.
         '''
-        #Entra aqui
-        if b_rot90:
-            #Entra aqui
-            self._Mnp_2Dslice = np.rot90(self._Mnp_2Dslice)
         if self.func == 'invertIntensities':
             # Nao entra aqui
             self.invert_slice_intensities()
 
-    d = collections.OrderedDict()
-    def slice_save(self, astr_outputFile):
+    def render_params(self, astr_outputFile):
+        '''
+        Everything besides the voxel data that determines how a slice is
+        rendered to <astr_outputFile>.
+        '''
+        if self._str_colorTxtContents is None:
+            self._str_colorTxtContents = ''
+            if self.colorTxt and os.path.isfile(self.colorTxt):
+                with open(self.colorTxt) as f:
+                    self._str_colorTxtContents = f.read()
+        return (self.segmentationType, self._str_colorTxtContents,
+                self.blueLimit, self.minBlueLimit, self.minAllowedValue,
+                self.func, self._b_flipSlice, self._encoder.params(), self._str_colorMode,
+                astr_outputFile.rsplit('.', 1)[-1])
+
+    def slice_output(self, astr_outputFile):
+        '''
+        Produces the output file of the current slice.
+
+        If deduplication or the render cache is enabled, the slice is
+        fingerprinted from its voxels and render parameters first. A
+        slice identical to one already written in this run is linked to
+        that file; one found in the render cache is restored from it.
+        Only the remaining slices are rendered.
+        '''
+        if not (self._b_dedupSlices or self._renderCache is not None) or \
+           astr_outputFile.endswith('.dcm') or self._b_tiles:
+            # (DICOM output also carries per-slice headers, and tiles are
+            # not cached)
+            return self.slice_save(astr_outputFile)
+        str_key = RenderCache.key(self._Mnp_2Dslice, self.render_params(astr_outputFile))
+        if self._b_dedupSlices and str_key in self._d_renderedSlice:
+            self._log('Outputfile = %s (duplicate)\n' % astr_outputFile)
+            if self._writer is not None:
+                self._writer.wait(self._d_renderedSlice[str_key])
+            file_link(self._d_renderedSlice[str_key], astr_outputFile)
+            self._dedupCount += 1
+            return
+        if self._renderCache is None or not self._renderCache.fetch(str_key, astr_outputFile):
+            if self._renderCache is not None:
+                self.slice_save(astr_outputFile, lambda: self._renderCache.store(str_key, astr_outputFile))
+            else:
+                self.slice_save(astr_outputFile)
+        if self._b_dedupSlices:
+            self._d_renderedSlice[str_key] = astr_outputFile
+
+    def gray_colormap(self, sliceMaxValue):
+        '''
+        Grayscale colormap for slices whose maximum is <sliceMaxValue>:
+        Greys_r sampled at i/sliceMaxValue, except that 0 is mapped to
+        transparency. The ramp is evaluated in one vectorized call, and
+        the last few colormaps are kept for slices with the same maximum.
+        '''
+        if sliceMaxValue in self._d_grayColormap:
+            self._d_grayColormap.move_to_end(sliceMaxValue)
+            return self._d_grayColormap[sliceMaxValue]
+        if sliceMaxValue == 0:
+            greyValuesForSlice = np.array([(0, 0, 0, 0), (1, 1, 1, 1)], dtype=float)
+        else:
+            greyValuesForSlice = np.concatenate([np.zeros((1, 4)),
+                                                 cm.Greys_r(np.arange(1, int(sliceMaxValue)) / sliceMaxValue)])
+        ModifiedGreys_r = LinearSegmentedColormap.from_list('newcmap', greyValuesForSlice, N=len(greyValuesForSlice))
+        self._d_grayColormap[sliceMaxValue] = ModifiedGreys_r
+        if len(self._d_grayColormap) > self.GRAY_COLORMAP_CACHE:
+            self._d_grayColormap.popitem(last=False)
+        return ModifiedGreys_r
+
+    def background_pixel(self, b_removeBackground):
+        '''
+        Where renderer.render() samples the background color of the
+        current slice: pixel (1, 1) of the slice before its vertical
+        flip, or None to keep the background.
+        '''
+        if not b_removeBackground:
+            return None
+        if self._b_flipSlice:
+            return (self._Mnp_2Dslice.shape[0] - 2, 1)
+        return (1, 1)
+
+    def slice_save(self, astr_outputFile, done=None):
         '''
         Saves a single slice.
 
@@ -436,229 +762,185 @@ class med2image(object):
 
         o astr_output
         The output filename to save the slice to.
+
+        o done
+        Called once the file is written (which, with a SliceWriter, is
+        after this returns).
         '''
         self._log('Outputfile = %s\n' % astr_outputFile)
         fformat = astr_outputFile.split('.')[-1]
+        # Never write through an existing file: it may be a hardlink into
+        # the render cache.
+        if os.path.lexists(astr_outputFile):
+            os.remove(astr_outputFile)
         if fformat == 'dcm':
             if self._dcm:
-                self._dcm.pixel_array.flat = self._Mnp_2Dslice.flat
-                self._dcm.PixelData = self._dcm.pixel_array.tostring()
-                self._dcm.save_as(astr_outputFile)
+                dcm = self.dcm_template()
+                dcm.Rows, dcm.Columns = self._Mnp_2Dslice.shape
+                dcm.add_new(0x7fe00010, 'OB' if int(dcm.BitsAllocated) <= 8 else 'OW',
+                            np.ascontiguousarray(self._Mnp_2Dslice, dtype = dcm_dtype(dcm)).tobytes())
+                if dcm.file_meta.TransferSyntaxUID.is_compressed:
+                    dcm.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+                self.output_write(astr_outputFile, lambda: dcm.save_as(astr_outputFile), done)
             else:
                 raise ValueError('dcm output format only available for DICOM files')
         else:
-#-
-            #print (cm.Greys_r)
-            #print (mycm)
-            # print ("[med2image 474] self._Mnp_2Dslice",self._Mnp_2Dslice[620])
-            # print ("[med2image 475] self._Mnp_2Dslice",len(self._Mnp_2Dslice))
-            # print ("[med2image 476] astr_outputFile",astr_outputFile)
-            #print (self._str_sliceToConvert )
-            #print (numpy.unique(self._Mnp_2Dslice))
-            #len(d)
-            # for key in slice_keys:
-            #     if key in global_color_dict:
-            #         slice_color_dict[key] = global_color_dict[key]
-            # if len(slice_keys) <= 1:
-            #     print ('a')
-            #     slice_color_dict = global_color_dict.copy()
-            # print("self.d len ", len(self.d))
-            # slice_color_dict = global_color_dict.copy()
-            # mycolors = list(slice_color_dict.values())*50
-            #print ("len slice_keys =", len(slice_keys))
-
-            #pylab.imsave(astr_outputFile, self._Mnp_2Dslice, format=fformat, cmap = cm.Greys_r)
-            #pylab.imsave('/home/luciano/nifti_data/MYCM-output.png', self._Mnp_2Dslice, format=fformat, cmap = mycm)
-
-            # print('np.unique(self._Mnp_2Dslice)', np.unique(self._Mnp_2Dslice))
-            flagRemoveTransparency = False  # remove fundo pixel a pixel (tipos: Segmentada Poro e Projecao Tomografica;
-                                            # outros tipos: deve usar o valor 0 mapeado na cor (0,0,0,0) pelo colormap
-
-
-            # unique = np.unique(self._Mnp_2Dslice)
-            # print(">>>>>>>>>>>>>>unique",unique)
-
-            ## Correcao do colormap de tons de cinza que para matrizes que nao tenha o valor maximo 255
-            # Copia o colormap de tons de cinza, exceto para o valor 0, que sera mapeado em transparencia
-            if self.segmentationType in self.NON_COLORED_TYPES:
-                try:
-                    # sliceUniqueValues = np.unique(self._Mnp_2Dslice)
-                    # greyValuesForSlice = [(0, 0, 0, 0)] + list(map(cm.Greys_r, sliceUniqueValues))
-                    sliceMaxValue = np.amax(self._Mnp_2Dslice)
-                    if sliceMaxValue == 0:
-                        greyValuesForSlice = [(0, 0, 0, 0)] + [(1,1,1,1)]
-                    else:
-                        # greyValuesForSlice = [(0, 0, 0, 0)] + list(map(cm.Greys_r, range(1,sliceMaxValue)))
-                        greyValuesForSlice = [(0, 0, 0, 0)] + [cm.Greys_r(i/sliceMaxValue) for i in range(1, int(sliceMaxValue))]
-                    # print("----------[med2image] sliceMaxValue",sliceMaxValue)
-                    # print("----------[med2image] greyValuesForSlice",greyValuesForSlice)
-
-                    ModifiedGreys_r = LinearSegmentedColormap.from_list('newcmap', greyValuesForSlice, N=len(greyValuesForSlice))
-                except Exception as ex:
-                    print("[med2image] Ocorreu um erro nao esperado na geracao colormap cinza", ex)
-                    ModifiedGreys_r = cm.Greys_r
-            else:
-                ModifiedGreys_r = cm.Greys_r
+            self.image_output(self.slice_image(fformat), astr_outputFile, fformat, self._b_tiles, done)
 
-            if self.segmentationType == self.SEG_PORE_LABELED:
-                # pylab.imsave(astr_outputFile, self._Mnp_2Dslice, format=fformat, cmap = self.mycm)
-                unique = np.unique(self._Mnp_2Dslice)
-
-                # debug = False
-                # if "x/" in astr_outputFile:
-                #     debug = True
-
-                # Para funcionar corretamente, devemos eliminar do colormap as cores que nao serao usadas na matriz atual
-                sliceColors = []
-                transparency = self.mycolors[0]
-                nonTransparentColors = self.mycolors[1:]
-                nonTransparentColorsLen = len(nonTransparentColors)
-
-                lastMin = 1
-                for index,value in enumerate(unique):
-                    # As cores se repetem a cada index = N * len(self.mycolors)
-                    # if debug:
-                    #     print("---------------------[med2image 551] value",value)
-                    if value == 0:
-                        sliceColors.append(transparency)
-                    else:
-                        nonTransparentColorsIndex = (value - 1) %  nonTransparentColorsLen
-                        # if debug:
-                        #     print("-------------[med2image 552] nonTransparentColors[nonTransparentColorsIndex]",nonTransparentColors[nonTransparentColorsIndex])
-                        for innerIndex in range(lastMin,value+1):
-                            # Adiciona cores aos valores intermediarios, mesmo que nao sejam usadas (provavelmente tem uma solucao melhor)
-                            # Se nao fizer esse trecho, mapeia 0 - transp; 1 - cor 1; 2 - cor 2; etc
-                            sliceColors.append(nonTransparentColors[nonTransparentColorsIndex])
-                        lastMin = value + 1
-
-                # mapeamento 1 cor : 1 intervalo de valor, ja adicionados os valores e cores que nao serao usados
-                modifiedColormap = ListedColormap(sliceColors)
-
-                pylab.imsave(astr_outputFile, self._Mnp_2Dslice, format=fformat, cmap=modifiedColormap)
-
-            elif self.segmentationType in self.COLORED_TYPES:
-                unique = np.unique(self._Mnp_2Dslice)
-                # Para funcionar corretamente, devemos eliminar do colormap as cores que nao serao usadas na matriz atual
-                sliceColors = [c for index,c in enumerate(self.mycolors) if index in unique]
-
-                # mapeamento 1 cor : 1 valor, ja eliminados os valores e cores que nao serao usados
-                modifiedColormap = ListedColormap(sliceColors)
-
-                pylab.imsave(astr_outputFile, self._Mnp_2Dslice, format=fformat, cmap = modifiedColormap)
-            elif self.segmentationType == self.SEG_PORE:
-                # =============== obtendo somente pixels azuis para gerar camada transparente dos poros =============#
-                try:
-                    ## Primeira parte: salva a imagem de fundo em escala de cinzas
-                    # pylab.imsave(astr_outputFile, self._Mnp_2Dslice, format=fformat, cmap=cm.Greys_r)
-
-                    # Precisa do maximo para que exista uma regra do colormap para todos os numeros de 0 ate o maximo
-                    # sliceMaxValue = np.amax(self._Mnp_2Dslice)
-
-                    # Copia o colormap de tons de cinza, exceto para o valor 0, que sera mapeado em transparencia
-                    # newcmap = LinearSegmentedColormap.from_list('newcmap',
-                    #                                             [(0, 0, 0, 0)] + list(map(cm.Greys_r, range(1,cm.Greys_r.N))),
-                    #                                             N=cm.Greys_r.N)
-                    newcmap = ModifiedGreys_r
-
-                    # Salva imagem sem poros azuis, soh escala de cinza
-                    pylab.imsave(astr_outputFile, self._Mnp_2Dslice, format=fformat, cmap=newcmap)
-
-                    ## Segunda parte: salva apenas os poros azuis e sobrepoe a imagem
-                    # Obtem lista de possiveis valores da matriz/slice atual para eliminar possiveis "pulos" do colormap
-                    # unique = np.unique(self._Mnp_2Dslice)
-                    # print(">>>>>>>>>>>>>>unique",unique)
-
-                    # Criando regra basica do colormap - transparente para todos os possiveis valores da matriz do slice
-                    linearColormap = [(0, 0, 0, 0) for _ in range(int(self.minAllowedValue) + 1, int(sliceMaxValue))]
-                    # linearColormap = [(0, 0, 0, 0) for _ in unique]
-
-                    # Para os valores entre 0 e o limite do poro azul, altera a regra do colormap para usar a cor azul
-                    for i in range(int(self.minAllowedValue) + 1, int(sliceMaxValue)):
-                    # for i in unique:
-                        # if i != 0 and i < self.minAllowedValue + self.blueLimit :
-                        if i != 0 and i > self.minBlueLimit and i < self.blueLimit :
-
-                            linearColormap[i] = (0, 0.972, 0.915, 1) # cor azul claro
-
-                    # Cria colormap de regras 1 cor : 1 valor
-                    CustomCmap = ListedColormap(linearColormap)
-                    # print(">>>>>>>>>>>>>>CustomCmap(0)",CustomCmap(0))
-                    # print(">>>>>>>>>>>>>>CustomCmap(1)",CustomCmap(1))
-                    # print(">>>>>>>>>>>>>>CustomCmap(10)",CustomCmap(10))
-                    # print(">>>>>>>>>>>>>>CustomCmap(20)",CustomCmap(20))
-                    # print(">>>>>>>>>>>>>>CustomCmap(30)",CustomCmap(30))
-                    # print(">>>>>>>>>>>>>>CustomCmap(40)",CustomCmap(40))
-                    # print(">>>>>>>>>>>>>>CustomCmap(255)",CustomCmap(255))
-
-                    # Salva arquivo temporario que sera a camada superficial com poros azuis e fundo transparente
-                    bluePoreTmpImgPath = astr_outputFile.replace('output','blue_pores')
-                    pylab.imsave(bluePoreTmpImgPath, self._Mnp_2Dslice, format=fformat, cmap=CustomCmap)
-
-                    # ones = self._Mnp_2Dslice.copy()
-                    # ones[:,350] = 24
-                    #
-                    # pylab.imsave(bluePoreTmpImgPath, ones, format=fformat, cmap=CustomCmap)
-
-                    background = Image.open(astr_outputFile)    # arquivo original em escala de cinza
-                    foreground = Image.open(bluePoreTmpImgPath) # arquivo com poros azuis
-
-                    # Sobrepoe os arquivos
-                    Image.alpha_composite(background, foreground).save(astr_outputFile)
-
-                    # Apaga arquivo temporario de poros azuis
-                    os.remove(bluePoreTmpImgPath)
-                except Exception as ex:
-                    print("[slice_save @ med2image 527] Ocorreu erro na sobreposicao de poros azuis", ex)
-                    print("[slice_save @ med2image] Utilizando imagem em escala de cinzas somente")
-                    flagRemoveTransparency = True
-                    pylab.imsave(astr_outputFile, self._Mnp_2Dslice, format=fformat, cmap=cm.Greys_r)
-                # =========================== fim do trecho para colorir com pixels azuis  ===========================#
+    def image_output(self, img, astr_outputFile, fformat, b_tiles=False, done=None):
+        '''
+        Encodes the rendered image <img> into <astr_outputFile> and, with
+        <b_tiles>, its tile pyramid, then calls done().
+        '''
+        def write():
+            renderer.image_write(img, astr_outputFile, fformat, self._encoder)
 
-            else:
-                flagRemoveTransparency = True
-                try:
-                    pylab.imsave(astr_outputFile, self._Mnp_2Dslice, format=fformat, cmap = ModifiedGreys_r) # original
-                except:
-                    pylab.imsave(astr_outputFile, self._Mnp_2Dslice, format=fformat, cmap=cm.Greys_r)  # original
+            # piramide de tiles DeepZoom, a partir da mesma imagem renderizada
+            if b_tiles:
+                pyramid.pyramid_save(img, astr_outputFile, fformat, self._tileSize,
+                                     self.segmentationType in self.SEGMENTED,
+                                     lambda tile, str_tileFile: renderer.image_write(tile, str_tileFile, fformat, self._encoder))
+        self.output_write(astr_outputFile, write, done)
+
+    def output_write(self, astr_outputFile, write, done=None):
+        '''
+        Runs write(), which produces <astr_outputFile>, and then done():
+        on the writer threads while the slices of an axis are rendered
+        with <writeJobs> > 0, otherwise right away.
+        '''
+        def write_done():
+            write()
+            if done is not None:
+                done()
+        if self._writer is None:
+            write_done()
+        else:
+            self._writer.submit(astr_outputFile, write_done)
 
-            #===================trecho para remover transparencia e inverter eixo z ==================#
+    def slice_image(self, fformat):
+        '''
+        Renders the current slice as a PIL image to be written in the
+        (non DICOM) format <fformat>.
+        '''
+        # modo "indexed": rotulos gravados como imagem de paleta (PNG "P" com tRNS), sem expandir para RGBA
+        b_indexed = self._str_colorMode == 'indexed' and fformat.lower() == 'png'
+        Mnp_index = None
+        # modo "gray": tons de cinza gravados num unico canal (PNG "L" com tRNS, ou "LA")
+        b_gray    = self._str_colorMode == 'gray' and fformat.lower() == 'png'
+        Mnp_gray  = None
+
+        flagRemoveTransparency = False  # remove a cor de fundo (tipos: Segmentada Poro e Projecao Tomografica;
+                                        # outros tipos: deve usar o valor 0 mapeado na cor (0,0,0,0) pelo colormap
+
+        ## Correcao do colormap de tons de cinza que para matrizes que nao tenha o valor maximo 255
+        # Copia o colormap de tons de cinza, exceto para o valor 0, que sera mapeado em transparencia
+        if self.segmentationType in self.NON_COLORED_TYPES:
             try:
-                # obtendo todos os rgb dos pixels
-                img = Image.open(astr_outputFile)
-                img = img.convert("RGBA")
-
-                # Se houve algum erro na geracao dos poros azuis, eh gerada apenas a imagem em escala de cinza com fundo preto
-                # O fundo sera removido manualmente
-                if flagRemoveTransparency:
-                    # obtendo cor de fundo
-                    rgb_im = img.convert('RGB')
-                    rgbFirstPixel = rgb_im.getpixel((1, 1))
-
-                    datas = img.getdata()
-                    newData = []
-                    for r,g,b,a in datas:
-                        if r == rgbFirstPixel[0] and g == rgbFirstPixel[1] and b == rgbFirstPixel[2]: # deixa o fundo transparente
-                            newData.append((255, 255, 255, 0))
-                        else: # usa a mesma cor
-                                newData.append((r, g, b, a))
-                    img.putdata(newData)
-
-                # soh precisa do flip no eixo z
-                axis = os.path.basename(os.path.dirname(astr_outputFile))
-                if axis == 'z':
-                    img = img.transpose(Image.FLIP_TOP_BOTTOM) # flip vertical
-
-                img.save(astr_outputFile, astr_outputFile.rsplit('.',1)[1]) #sobreescreve a imagem
+                ModifiedGreys_r = self.gray_colormap(np.amax(self._Mnp_2Dslice))
             except Exception as ex:
-                print("[med2image] Ocorreu um erro nao esperado na etapa de flip do eixo z/remocao da transparencia", ex)
-            # ===========================fim trecho para remover transparencia==========================#
+                print("[med2image] Ocorreu um erro nao esperado na geracao colormap cinza", ex)
+                ModifiedGreys_r = cm.Greys_r
+        else:
+            ModifiedGreys_r = cm.Greys_r
+
+        # Cada slice e mapeado por uma tabela RGBA (renderer.render), sem passar por pylab.imsave
+        if self.segmentationType == self.SEG_PORE_LABELED:
+            unique = np.unique(self._Mnp_2Dslice)
+
+            # Para funcionar corretamente, devemos eliminar do colormap as cores que nao serao usadas na matriz atual
+            sliceColors = []
+            transparency = self.mycolors[0]
+            nonTransparentColors = self.mycolors[1:]
+            nonTransparentColorsLen = len(nonTransparentColors)
+
+            lastMin = 1
+            for index,value in enumerate(unique):
+                # As cores se repetem a cada index = N * len(self.mycolors)
+                value = int(value)  # evita overflow em volumes uint8/uint16
+                if value == 0:
+                    sliceColors.append(transparency)
+                else:
+                    nonTransparentColorsIndex = (value - 1) %  nonTransparentColorsLen
+                    for innerIndex in range(lastMin,value+1):
+                        # Adiciona cores aos valores intermediarios, mesmo que nao sejam usadas (provavelmente tem uma solucao melhor)
+                        # Se nao fizer esse trecho, mapeia 0 - transp; 1 - cor 1; 2 - cor 2; etc
+                        sliceColors.append(nonTransparentColors[nonTransparentColorsIndex])
+                    lastMin = value + 1
+
+            # mapeamento 1 cor : 1 intervalo de valor, ja adicionados os valores e cores que nao serao usados
+            modifiedColormap = ListedColormap(sliceColors)
+
+            if b_indexed:
+                lut, offset = renderer.lut_build(modifiedColormap, self._Mnp_2Dslice)
+                if lut is not None:
+                    Mnp_index, Mnp_palette = renderer.palette_index(lut, offset, self._Mnp_2Dslice)
+            if Mnp_index is None:
+                Mnp_rgba = renderer.render(modifiedColormap, self._Mnp_2Dslice)
+
+        elif self.segmentationType in self.COLORED_TYPES:
+            # mapeamento 1 cor : 1 rotulo pela tabela do volume; rotulos sem cor ficam transparentes
+            if b_indexed:
+                Mnp_index, Mnp_palette = renderer.label_index(self._Mnp_labelLut, self._Mnp_2Dslice)
+            if Mnp_index is None:
+                Mnp_rgba = renderer.label_apply(self._Mnp_labelLut, self._Mnp_2Dslice)
+        elif self.segmentationType == self.SEG_PORE:
+            # =============== obtendo somente pixels azuis para gerar camada transparente dos poros =============#
+            try:
+                # Imagem em escala de cinzas com os poros (minBlueLimit < valor < blueLimit) pintados de azul,
+                # numa unica tabela RGBA: os poros sao decididos pelo valor do voxel, nao por um segundo colormap
+                Mnp_rgba = renderer.render(ModifiedGreys_r, self._Mnp_2Dslice,
+                                           paint=(self.minBlueLimit, self.blueLimit, self.BLUE_PORE_COLOR))
+            except Exception as ex:
+                print("[slice_save @ med2image 527] Ocorreu erro na sobreposicao de poros azuis", ex)
+                print("[slice_save @ med2image] Utilizando imagem em escala de cinzas somente")
+                flagRemoveTransparency = True
+                Mnp_rgba = renderer.render(cm.Greys_r, self._Mnp_2Dslice, self.background_pixel(flagRemoveTransparency))
+            # =========================== fim do trecho para colorir com pixels azuis  ===========================#
+
+        else:
+            flagRemoveTransparency = True
+            try:
+                if b_gray:
+                    Mnp_gray, grayKey = renderer.render_gray(ModifiedGreys_r, self._Mnp_2Dslice, self.background_pixel(flagRemoveTransparency))
+                if Mnp_gray is None:
+                    Mnp_rgba = renderer.render(ModifiedGreys_r, self._Mnp_2Dslice, self.background_pixel(flagRemoveTransparency)) # original
+            except:
+                Mnp_gray = None
+                Mnp_rgba = renderer.render(cm.Greys_r, self._Mnp_2Dslice, self.background_pixel(flagRemoveTransparency))  # original
+
+        # Se houve algum erro na geracao dos poros azuis, eh gerada apenas a imagem em escala de cinza com fundo preto
+        # O fundo ja foi removido na tabela de cores, antes de mapear o slice (renderer.render)
+        # O flip do eixo z ja foi aplicado ao slice (dim_save), como view
+
+        # imagem final, codificada uma unica vez por quem a grava
+        if Mnp_index is not None:
+            img = renderer.indexed_image(Mnp_index, Mnp_palette)
+        elif Mnp_gray is not None:
+            img = renderer.gray_image(Mnp_gray, grayKey)
+        else:
+            img = renderer.rgba_image(Mnp_rgba, fformat)
+        return img
 
+    def dcm_template(self):
+        '''
+        Returns a copy of the DICOM header to write the current slice
+        with: the header of the matching series file for z slices of a
+        volume, otherwise the header of the input file.
+        '''
+        dcm = self._dcm
+        if self._b_3D and self._str_sliceDim == 'z' and 0 <= self.slice_number < len(self._dcmList):
+            dcm = self._dcmList[self.slice_number]
+        return copy.deepcopy(dcm)
 
     def invert_slice_intensities(self):
         '''
         Inverts intensities of a single slice.
         '''
-        self._Mnp_2Dslice = self._Mnp_2Dslice*(-1) + self._Mnp_2Dslice.max()
+        # max - v can exceed the voxel type (int16 from -30000 to 30000
+        # gives up to 60000), so it is computed in a type at least as wide
+        # as int32; floating point slices stay floating point.
+        Mnp_slice         = self._Mnp_2Dslice.astype(np.result_type(self._Mnp_2Dslice.dtype, np.int32))
+        self._Mnp_2Dslice = Mnp_slice.max() - Mnp_slice
 
     # def generateBluePoreColormap(self,maxTotalValue,maxBlueValue=60):
     #     maxBlueValue += 1
@@ -683,6 +965,115 @@ class med2image(object):
     #     my_cmap = ListedColormap(my_cmap)
     #     return my_cmap
 
+def dcm_header_read(str_file):
+    '''
+    Reads a single DICOM file up to (but not including) its pixel data.
+    '''
+    return pydicom.dcmread(str_file, force=True, stop_before_pixels=True)
+
+def dcm_dtype(dcm):
+    '''
+    The numpy type of the decoded pixel data described by a DICOM header.
+    '''
+    bits = int(dcm.BitsAllocated)
+    if bits == 1:
+        return np.dtype(np.uint8)
+    if int(getattr(dcm, 'PixelRepresentation', 0)) == 1:
+        return np.dtype('int%d' % bits)
+    return np.dtype('uint%d' % bits)
+
+def dcm_sort_key(dcm):
+    '''
+    Position of a slice along the series normal, or None if the header
+    does not carry the patient geometry.
+    '''
+    try:
+        orientation = np.array(dcm.ImageOrientationPatient, dtype = float)
+        position    = np.array(dcm.ImagePositionPatient, dtype = float)
+    except (AttributeError, ValueError, TypeError):
+        return None
+    if orientation.size != 6 or position.size != 3:
+        return None
+    normal = np.cross(orientation[:3], orientation[3:])
+    return float(np.dot(position, normal))
+
+def dcm_read(str_file):
+    '''
+    Reads and decodes the pixel data of a single DICOM file.
+
+    Defined at module level so that it can be dispatched to a process
+    pool. Only the decoded array is returned; the dataset (and with it
+    the raw PixelData) is released as soon as the file is decoded.
+    '''
+    return pydicom.dcmread(str_file, force=True).pixel_array
+
+def executor_imap(executor, func, l_args, window):
+    '''
+    Like executor.map(), but keeps at most <window> tasks in flight and
+    does not hold on to results once they have been yielded.
+    '''
+    it_args  = iter(l_args)
+    q_future = collections.deque(executor.submit(func, arg) for arg in itertools.islice(it_args, window))
+    try:
+        while q_future:
+            future = q_future.popleft()
+            for arg in itertools.islice(it_args, 1):
+                q_future.append(executor.submit(func, arg))
+            yield future.result()
+    finally:
+        for future in q_future:
+            future.cancel()
+
+# Converter and axis passes being rendered by dim_render_parallel(),
+# inherited by its forked workers.
+_renderPass = None
+
+def render_task(task):
+    '''
+    Renders the slice range <task>, (axis, indexStart, indexStop), of
+    the axis passes in _renderPass, in a dim_render_parallel() worker.
+
+    Returns the deduplication, render cache hit and miss counts of the
+    range, and the rendered images if the axis is saved as an atlas.
+    '''
+    converter, l_axis           = _renderPass
+    axis, indexStart, indexStop = task
+    d_axis                      = l_axis[axis]
+    l_img                       = []
+    if d_axis['atlas'] is not None:
+        counts = converter.dim_render(d_axis, indexStart, indexStop, lambda i, img: l_img.append(img))
+    else:
+        counts = converter.dim_render(d_axis, indexStart, indexStop)
+    return counts, l_img
+
+def render_schedule(l_axis, tasks):
+    '''
+    Splits the slices of the axis passes <l_axis> into about <tasks>
+    contiguous ranges of equal cost, a slice costing its pixel count,
+    and orders them for a pool: the axis with the most work left gets
+    the next task, so every axis progresses at the same rate and the
+    short ones are done alongside the long ones, not after them.
+
+    Returns (axis, indexStart, indexStop) tuples, in submission order;
+    the ranges of each axis come in slice order.
+    '''
+    totalCost   = sum((d['indexStop'] - d['indexStart']) * d['slicePixels'] for d in l_axis)
+    taskCost    = totalCost / float(max(1, tasks))
+    l_queue     = []
+    l_cost      = []
+    for axis, d_axis in enumerate(l_axis):
+        step = max(1, int(math.ceil(taskCost / max(1, d_axis['slicePixels']))))
+        l_queue.append(collections.deque((axis, start, min(start + step, d_axis['indexStop']))
+                                         for start in range(d_axis['indexStart'], d_axis['indexStop'], step)))
+        l_cost.append((d_axis['indexStop'] - d_axis['indexStart']) * d_axis['slicePixels'])
+    l_task      = []
+    while any(l_queue):
+        axis                    = max((a for a in range(len(l_queue)) if l_queue[a]), key = lambda a: l_cost[a])
+        task                    = l_queue[axis].popleft()
+        l_cost[axis]           -= (task[2] - task[1]) * l_axis[axis]['slicePixels']
+        l_task.append(task)
+    return l_task
+
 class med2image_dcm(med2image):
     '''
     Sub class that handles DICOM data.
@@ -692,36 +1083,28 @@ class med2image_dcm(med2image):
 
         self.l_dcmFileNames = sorted(glob.glob('%s/*.dcm' % self._str_inputDir))
         self.slices         = len(self.l_dcmFileNames)
+        self.l_dcmHeader    = []
+        self.dcm_series_scan()
 
         if self._b_convertMiddleSlice:
             self._sliceToConvert = int(self.slices/2)
-            self._dcm            = pydicom.read_file(self.l_dcmFileNames[self._sliceToConvert],force=True)
-            self._str_inputFile  = self.l_dcmFileNames[self._sliceToConvert]
             if not self._str_outputFileStem.startswith('%'):
                 self._str_outputFileStem, ext = os.path.splitext(self.l_dcmFileNames[self._sliceToConvert])
-        if not self._b_convertMiddleSlice and self._sliceToConvert != -1:
-            self._dcm = pydicom.read_file(self.l_dcmFileNames[self._sliceToConvert],force=True)
+        if self._sliceToConvert != -1:
+            # Um corte so: leitura completa apenas do arquivo convertido
             self._str_inputFile = self.l_dcmFileNames[self._sliceToConvert]
+            self._dcm = pydicom.dcmread(self._str_inputFile,force=True)
         else:
-            self._dcm = pydicom.read_file(self._str_inputFile,force=True)
-        if self._sliceToConvert == -1:
             self._b_3D = True
-            self._dcm = pydicom.read_file(self._str_inputFile,force=True)
-            image = self._dcm.pixel_array
-            shape2D = image.shape
-            #print(shape2D)
-            self._Vnp_3DVol = np.empty( (shape2D[0], shape2D[1], self.slices) )
-            i = 0
-            for img in self.l_dcmFileNames:
-                self._dcm = pydicom.read_file(img,force=True)
-                image = self._dcm.pixel_array
-                self._dcmList.append(self._dcm)
-                #print('%s: %s\n' % (img, image.shape))
-                try:
-                    self._Vnp_3DVol[:,:,i] = image
-                except Exception as e:
-                    error.fatal(self, 'dcmInsertionFail', '\nFor input DICOM file %s\n%s\n' % (img, str(e)))
-                i += 1
+            self.dcm_series_check()
+            if self._str_inputFile in self.l_dcmFileNames:
+                self._dcm = self._dcmList[self.l_dcmFileNames.index(self._str_inputFile)]
+            else:
+                self._dcm = dcm_header_read(self._str_inputFile)
+            # Fortran order keeps every z slice (one DICOM file) contiguous,
+            # for both filling the volume and reading it back slice by slice.
+            self._Vnp_3DVol = np.empty(self._dcmShape, dtype = self._dcmDtype, order = 'F')
+            self.dcm_volume_read()
         if self._str_outputFileStem.startswith('%'):
             str_spec = self._str_outputFileStem
             self._str_outputFileStem = ''
@@ -737,8 +1120,103 @@ class med2image_dcm(med2image):
                     self._str_outputFileStem = str_fileComponent
                 else:
                     self._str_outputFileStem = self._str_outputFileStem + '-' + str_fileComponent
-        image = self._dcm.pixel_array
-        self._Mnp_2Dslice = image
+        if not self._b_3D:
+            self._Mnp_2Dslice = self._dcm.pixel_array
+
+    def dcm_series_scan(self):
+        '''
+        Header-only first pass over the series.
+
+        Reads every header (stopping before the pixel data), orders the
+        files by their position along the slice normal (falling back to
+        InstanceNumber, then to the file name).
+        '''
+        if not self.slices:
+            return
+        if self._readJobs > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers = self._readJobs) as executor:
+                l_header = list(executor.map(dcm_header_read, self.l_dcmFileNames))
+        else:
+            l_header = [dcm_header_read(img) for img in self.l_dcmFileNames]
+
+        l_position = [dcm_sort_key(dcm) for dcm in l_header]
+        l_instance = [getattr(dcm, 'InstanceNumber', None) for dcm in l_header]
+        if None not in l_position:
+            l_key = l_position
+        elif None not in l_instance:
+            l_key = [int(n) for n in l_instance]
+        else:
+            l_key = [0] * self.slices
+        l_order = sorted(range(self.slices), key = lambda i: (l_key[i], self.l_dcmFileNames[i]))
+        self.l_dcmFileNames = [self.l_dcmFileNames[i] for i in l_order]
+        self.l_dcmHeader    = [l_header[i] for i in l_order]
+        self._dcmList       = self.l_dcmHeader
+
+    def dcm_series_check(self):
+        '''
+        Checks that all slices of the scanned series share
+        Rows/Columns/BitsAllocated and derives the shape and type of the
+        volume. Only needed to build the volume: an inconsistent series
+        fails here, before any pixel data is decoded.
+        '''
+        reference = self.l_dcmHeader[0]
+        for img, dcm in zip(self.l_dcmFileNames, self.l_dcmHeader):
+            for tag in ['Rows', 'Columns', 'BitsAllocated']:
+                if getattr(dcm, tag, None) != getattr(reference, tag, None):
+                    error.fatal(self, 'dcmSeriesInconsistent',
+                                '\nFor input DICOM file %s\n%s is %s, expected %s\n' % (
+                                img, tag, getattr(dcm, tag, None), getattr(reference, tag, None)))
+        try:
+            self._dcmShape = (int(reference.Rows), int(reference.Columns), self.slices)
+            self._dcmDtype = dcm_dtype(reference)
+        except AttributeError as e:
+            error.fatal(self, 'dcmSeriesInconsistent',
+                        '\nFor input DICOM file %s\n%s\n' % (self.l_dcmFileNames[0], str(e)))
+
+    def dcm_executor(self):
+        '''
+        Returns the pool used to read the series, or None to read it
+        serially.
+
+        Reading uncompressed data is I/O bound, so threads suffice.
+        Compressed transfer syntaxes are decode bound and go to a
+        process pool instead.
+        '''
+        if self._readJobs <= 1 or self.slices <= 1:
+            return None
+        workers = min(self._readJobs, self.slices)
+        try:
+            b_compressed = self.l_dcmHeader[0].file_meta.TransferSyntaxUID.is_compressed
+        except AttributeError:
+            b_compressed = False
+        if b_compressed:
+            return concurrent.futures.ProcessPoolExecutor(max_workers = workers)
+        return concurrent.futures.ThreadPoolExecutor(max_workers = workers)
+
+    def dcm_volume_read(self):
+        '''
+        Reads every file in the series into the preallocated volume,
+        using <readJobs> workers. Slices are inserted in place and in
+        series order as they are decoded, and each decoded buffer is
+        dropped right after the copy; the headers kept in _dcmList
+        carry no pixel data.
+        '''
+        executor = self.dcm_executor()
+        if executor is None:
+            results = map(dcm_read, self.l_dcmFileNames)
+        else:
+            results = executor_imap(executor, dcm_read, self.l_dcmFileNames, 2 * self._readJobs)
+        try:
+            for i, (img, image) in enumerate(zip(self.l_dcmFileNames, results)):
+                try:
+                    self._Vnp_3DVol[:,:,i] = image
+                except Exception as e:
+                    error.fatal(self, 'dcmInsertionFail', '\nFor input DICOM file %s\n%s\n' % (img, str(e)))
+                del image
+        finally:
+            if executor is not None:
+                results.close()
+                executor.shutdown(wait = False)
 
     def sanitize(value):
         # convert to string and remove trailing spaces
@@ -805,9 +1283,11 @@ class med2image_dcm(med2image):
         if self._b_3D:
             rotCount = 0
             if self._b_reslice:
+                l_dims = []
                 for dim in ['x', 'y', 'z']:
-                    self.dim_save(dimension = dim, makeSubDir = True, rot90 = l_rot90[rotCount], indexStart = 0, indexStop = -1)
+                    l_dims.append(dict(dimension = dim, makeSubDir = True, rot90 = l_rot90[rotCount], indexStart = 0, indexStop = -1))
                     rotCount += 1
+                self.dims_save(l_dims)
             else:
                 self.dim_save(dimension = 'z', makeSubDir = False, rot90 = False, indexStart = 0, indexStop = -1)
 
@@ -819,16 +1299,40 @@ class med2image_nii(med2image):
 
     def __init__(self, **kwargs):
         med2image.__init__(self, **kwargs)
-        nimg = nib.load(self._str_inputFile)
-        data = nimg.get_fdata()
+        if self._memoryBudget:
+            self._b_lazy = True
+        nimg = nifti_load(self._str_inputFile,
+                          cacheDir = self._str_niftiCache,
+                          seekable = self._b_lazy)
+        if self._b_lazy:
+            # Keep the (memory mapped, if uncompressed) proxy and only
+            # read the slices that dim_save asks for.
+            data = nimg.dataobj
+        else:
+            # Keep the on-disk voxel type; only scaled images (non-unit
+            # scl_slope/scl_inter) come back as floating point.
+            data = np.asanyarray(nimg.dataobj)
         if data.ndim == 4:
             self._Vnp_4DVol     = data
             self._b_4D          = True
         if data.ndim == 3:
             # Entra aqui
+            if self._b_lazy:
+                data            = self.volume_open(data)
             self._Vnp_3DVol     = data
             self._b_3D          = True
 
+    def volume_open(self, dataobj, frame = None):
+        '''
+        Wraps an image proxy (or one frame of it) for on-demand slicing.
+        With a memory budget, slices are assembled from a bounded cache
+        of bricks instead of being read straight from the proxy.
+        '''
+        volume = LazyVolume(dataobj, frame = frame)
+        if self._memoryBudget:
+            volume = ChunkedVolume(volume, self._memoryBudget)
+        return volume
+
     def run(self):
         '''
         Runs the NIfTI conversion based on internal state.
@@ -862,7 +1366,10 @@ class med2image_nii(med2image):
 
         for f in range(frameStart, frameEnd):
             if self._b_4D:
-                self._Vnp_3DVol = self._Vnp_4DVol[:,:,:,f]
+                if self._b_lazy:
+                    self._Vnp_3DVol = self.volume_open(self._Vnp_4DVol, frame = f)
+                else:
+                    self._Vnp_3DVol = self._Vnp_4DVol[:,:,:,f]
             slices     = self._Vnp_3DVol.shape[2]
             if self._b_convertMiddleSlice:
                 self._sliceToConvert = int(slices/2)
@@ -875,7 +1382,7 @@ class med2image_nii(med2image):
 
             misc.mkdir(self._str_outputDir)
             if self._b_reslice:
-                for dim in ['x', 'y', 'z']:
-                    self.dim_save(dimension = dim, makeSubDir = True, indexStart = sliceStart, indexStop = sliceEnd, rot90 = True)
+                self.dims_save([dict(dimension = dim, makeSubDir = True, indexStart = sliceStart, indexStop = sliceEnd, rot90 = True)
+                                for dim in ['x', 'y', 'z']])
             else:
                 self.dim_save(dimension = 'z', makeSubDir = False, indexStart = sliceStart, indexStop = sliceEnd, rot90 = True)
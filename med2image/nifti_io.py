@@ -0,0 +1,141 @@
+# NAME
+#
+#        nifti_io
+#
+# DESCRIPTION
+#
+#        NIfTI loading helpers for med2image. Gzipped volumes can only
+#        be read sequentially, so every slice access would inflate the
+#        stream from the start. This module offers two ways around it:
+#
+#          o a one-time decompression into a local cache directory,
+#            after which the volume is memory mapped like any .nii;
+#          o a seek index over the gzip stream (requires the optional
+#            'indexed_gzip' package), built on first read and stored
+#            next to the input as a '.gzidx' sidecar.
+#
+
+# System imports
+import os
+import gzip
+import shutil
+import hashlib
+import tempfile
+
+# System dependency imports
+import nibabel as nib
+
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
+# Distance between seek points in the gzip index (bytes of output).
+GZIP_INDEX_SPACING = 4 * 1024 * 1024
+
+
+def is_gzip(str_inputFile):
+    return str_inputFile.endswith('.gz')
+
+
+def cache_path(str_inputFile, str_cacheDir):
+    '''
+    Name of the decompressed copy of <str_inputFile> in <str_cacheDir>.
+
+    The name is keyed on the absolute path, size and modification time
+    of the input, so a changed input never reuses a stale copy.
+    '''
+    stat    = os.stat(str_inputFile)
+    str_key = '%s:%d:%d' % (os.path.abspath(str_inputFile), stat.st_size, stat.st_mtime_ns)
+    str_hash = hashlib.sha1(str_key.encode()).hexdigest()[:16]
+    str_stem = os.path.basename(str_inputFile)[:-len('.gz')]
+    if str_stem.endswith('.nii'):
+        str_stem = str_stem[:-len('.nii')]
+    return os.path.join(str_cacheDir, '%s-%s.nii' % (str_stem, str_hash))
+
+
+def cache_decompress(str_inputFile, str_cacheDir):
+    '''
+    Returns the path of an uncompressed copy of <str_inputFile>,
+    decompressing it into <str_cacheDir> the first time it is asked for.
+    '''
+    str_cached = cache_path(str_inputFile, str_cacheDir)
+    if os.path.isfile(str_cached):
+        return str_cached
+    os.makedirs(str_cacheDir, exist_ok=True)
+    fd, str_tmp = tempfile.mkstemp(dir=str_cacheDir, suffix='.part')
+    try:
+        with gzip.open(str_inputFile, 'rb') as fin, os.fdopen(fd, 'wb') as fout:
+            shutil.copyfileobj(fin, fout, 16 * 1024 * 1024)
+        os.replace(str_tmp, str_cached)
+    except BaseException:
+        if os.path.exists(str_tmp):
+            os.remove(str_tmp)
+        raise
+    return str_cached
+
+
+def index_path(str_inputFile):
+    return str_inputFile + '.gzidx'
+
+
+def indexed_open(str_inputFile):
+    '''
+    Opens <str_inputFile> as a seekable gzip stream.
+
+    An up-to-date sidecar index is imported if there is one; otherwise
+    the full index is built (a single pass over the stream) and saved
+    as a sidecar for later runs. Failing to write the sidecar is not an
+    error, the index is then simply rebuilt next time.
+    '''
+    fobj        = indexed_gzip.IndexedGzipFile(str_inputFile, spacing=GZIP_INDEX_SPACING)
+    str_index   = index_path(str_inputFile)
+    if os.path.isfile(str_index) and \
+       os.path.getmtime(str_index) >= os.path.getmtime(str_inputFile):
+        try:
+            fobj.import_index(str_index)
+            return fobj
+        except Exception:
+            fobj.close()
+            fobj = indexed_gzip.IndexedGzipFile(str_inputFile, spacing=GZIP_INDEX_SPACING)
+    fobj.build_full_index()
+    try:
+        fobj.export_index(str_index)
+    except (OSError, IOError):
+        pass
+    return fobj
+
+
+def nifti_load(str_inputFile, **kwargs):
+    '''
+    Loads a NIfTI image, making gzipped input cheap to access slice by
+    slice.
+
+    ARGS
+
+    o cacheDir
+    If given, gzipped input is decompressed once into this directory
+    and the uncompressed copy is loaded (and memory mapped) instead.
+
+    o seekable
+    If True and no cache is used, gzipped input is opened through a
+    seek index (see indexed_open()) when 'indexed_gzip' is installed.
+    '''
+    str_cacheDir    = ''
+    b_seekable      = False
+    for key, val in kwargs.items():
+        if key == 'cacheDir':   str_cacheDir    = val
+        if key == 'seekable':   b_seekable      = val
+
+    if not is_gzip(str_inputFile):
+        return nib.load(str_inputFile)
+    if str_cacheDir:
+        return nib.load(cache_decompress(str_inputFile, str_cacheDir))
+    if b_seekable and indexed_gzip is not None:
+        fobj = indexed_open(str_inputFile)
+        try:
+            return nib.Nifti1Image.from_stream(fobj)
+        except nib.spatialimages.HeaderDataError:
+            fobj.seek(0)
+            return nib.Nifti2Image.from_stream(fobj)
+    return nib.load(str_inputFile)
@@ -0,0 +1,75 @@
+# NAME
+#
+#        pyramid
+#
+# DESCRIPTION
+#
+#        DeepZoom tile pyramids of rendered slices for med2image.
+#
+#        A slice image <stem>.<ext> is accompanied by <stem>.dzi, the
+#        DeepZoom descriptor, and by <stem>_files/<level>/<col>_<row>.<ext>
+#        tiles. Level 0 is a single pixel; every level doubles the
+#        resolution of the one below, up to the full-resolution image at
+#        the top level. The pyramid is built by successive halving of the
+#        rendered image, so it costs about a third of the full-resolution
+#        encode on top of it.
+#
+#        Label images are downsampled by picking pixels (nearest), so no
+#        segmentation color is ever blended with another. Grayscale images
+#        are downsampled by averaging (a box filter, alpha weighted).
+#
+
+# System imports
+import os
+import math
+
+# System dependency imports
+from PIL import Image
+
+DZI_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="%s" Overlap="0" TileSize="%d">
+  <Size Width="%d" Height="%d"/>
+</Image>
+'''
+
+
+def pyramid_levels(img, b_labels):
+    '''
+    Yields (level, image) from the top (full resolution) level of the
+    pyramid of <img> down to level 0.
+    '''
+    width, height   = img.size
+    level           = int(math.ceil(math.log2(max(width, height, 1))))
+    if b_labels:
+        resample    = Image.NEAREST
+    else:
+        resample    = Image.BOX
+        if 'transparency' in img.info and img.mode in ['L', 'RGB']:
+            # a transparency key would be averaged as a color
+            img = img.convert('LA' if img.mode == 'L' else 'RGBA')
+    while True:
+        yield level, img
+        if level == 0:
+            break
+        width, height   = (width + 1) // 2, (height + 1) // 2
+        img             = img.resize((width, height), resample)
+        level          -= 1
+
+
+def pyramid_save(img, astr_outputFile, fformat, tileSize, b_labels, save):
+    '''
+    Writes the DeepZoom descriptor and tiles of <img>, the image written
+    as <astr_outputFile>. <save>(image, path) encodes one tile, as the
+    full-resolution image was encoded.
+    '''
+    str_stem, str_ext = os.path.splitext(astr_outputFile)
+    for level, img_level in pyramid_levels(img, b_labels):
+        str_levelDir = os.path.join('%s_files' % str_stem, str(level))
+        os.makedirs(str_levelDir, exist_ok=True)
+        width, height = img_level.size
+        for row, top in enumerate(range(0, height, tileSize)):
+            for col, left in enumerate(range(0, width, tileSize)):
+                box = (left, top, min(left + tileSize, width), min(top + tileSize, height))
+                save(img_level.crop(box), os.path.join(str_levelDir, '%d_%d%s' % (col, row, str_ext)))
+    with open('%s.dzi' % str_stem, 'w') as f:
+        f.write(DZI_TEMPLATE % (str_ext[1:], tileSize, img.size[0], img.size[1]))
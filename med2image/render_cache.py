@@ -0,0 +1,92 @@
+# NAME
+#
+#        render_cache
+#
+# DESCRIPTION
+#
+#        A persistent cache of rendered slices for med2image.
+#
+#        Every rendered slice is stored under a key derived from its
+#        voxel data and from everything that influences how it is
+#        drawn (segmentation type, colormap contents, limits, transforms
+#        and output format). A later run that produces the same key
+#        restores the file from the cache instead of rendering it, and
+#        leaves an output that is already the cached file untouched.
+#
+
+# System imports
+import os
+import shutil
+import threading
+import hashlib
+
+import numpy as np
+
+# Bump whenever a change to the renderer alters the pixels it writes,
+# so that entries written by older code are not reused.
+RENDER_VERSION = 6
+
+
+def file_link(str_source, str_target):
+    '''
+    Makes <str_target> a hardlink to <str_source>, falling back to a
+    copy when the two paths cannot share an inode. The target is
+    replaced atomically if it already exists, also when several
+    threads or processes link to it at once.
+    '''
+    str_tmp = '%s.%d.%d.tmp' % (str_target, os.getpid(), threading.get_ident())
+    try:
+        os.link(str_source, str_tmp)
+    except OSError:
+        shutil.copyfile(str_source, str_tmp)
+    os.replace(str_tmp, str_target)
+
+
+class RenderCache(object):
+    '''
+    Content-addressed store of rendered slice files.
+    '''
+
+    def __init__(self, str_cacheDir):
+        self._str_cacheDir  = str_cacheDir
+        self.hits           = 0
+        self.misses         = 0
+        os.makedirs(str_cacheDir, exist_ok=True)
+
+    @staticmethod
+    def key(Mnp_slice, params):
+        '''
+        Hash of the slice voxels (with their shape and type) and of the
+        render parameters <params>, any repr()-able value.
+        '''
+        Mnp_slice   = np.ascontiguousarray(Mnp_slice)
+        h           = hashlib.blake2b(digest_size=20)
+        h.update(repr((RENDER_VERSION, Mnp_slice.shape, Mnp_slice.dtype.str, params)).encode())
+        h.update(Mnp_slice.data)
+        return h.hexdigest()
+
+    def path(self, str_key, str_ext):
+        return os.path.join(self._str_cacheDir, str_key[:2], '%s.%s' % (str_key, str_ext))
+
+    def fetch(self, str_key, str_outputFile):
+        '''
+        Restores the entry <str_key> as <str_outputFile>. Returns False
+        if there is no such entry.
+        '''
+        str_cached = self.path(str_key, str_outputFile.rsplit('.', 1)[-1])
+        if not os.path.isfile(str_cached):
+            self.misses += 1
+            return False
+        self.hits += 1
+        if os.path.isfile(str_outputFile) and os.path.samefile(str_cached, str_outputFile):
+            return True
+        file_link(str_cached, str_outputFile)
+        return True
+
+    def store(self, str_key, str_outputFile):
+        '''
+        Adds the freshly written <str_outputFile> as entry <str_key>.
+        '''
+        str_cached = self.path(str_key, str_outputFile.rsplit('.', 1)[-1])
+        os.makedirs(os.path.dirname(str_cached), exist_ok=True)
+        file_link(str_outputFile, str_cached)
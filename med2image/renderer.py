@@ -0,0 +1,303 @@
+# NAME
+#
+#        renderer
+#
+# DESCRIPTION
+#
+#        Lookup-table slice rendering for med2image.
+#
+#        Instead of handing every slice to pylab.imsave (which normalizes
+#        and colormaps each pixel, encodes a PNG that is then re-read and
+#        re-encoded), a colormap is evaluated once over the range of
+#        voxel values of a slice into a uint8 RGBA table, and the slice is
+#        mapped through it with a single NumPy indexing operation. The
+#        table is computed with the very normalization imsave applies, so
+#        the rendered pixels are identical.
+#
+
+# System imports
+import numpy as np
+
+# System dependency imports
+import matplotlib.cm as cm
+import matplotlib.colors as mcolors
+from PIL import Image
+
+# Integer slices whose table would exceed this many entries are mapped
+# pixel by pixel instead. Besides this bound, a table may have up to
+# LUT_PIXEL_RATIO entries per slice pixel, or LUT_MIN_SIZE entries, so
+# that a small slice never builds a large table.
+LUT_MAX_SIZE = 1 << 24
+LUT_MIN_SIZE = 1 << 16
+LUT_PIXEL_RATIO = 4
+
+# Entries of a PNG palette.
+PALETTE_SIZE = 256
+
+
+def lut_build(cmap, Mnp_slice):
+    '''
+    Evaluates <cmap> the way pylab.imsave would for <Mnp_slice> (scaled
+    between the slice minimum and maximum) over every value the slice
+    can hold.
+
+    Returns (lut, offset) such that lut[v - offset] is the uint8 RGBA
+    color of value v, or (None, None) if the slice is not integer typed
+    or its range is too wide for a table.
+    '''
+    if not np.issubdtype(Mnp_slice.dtype, np.integer):
+        return None, None
+    vmin, vmax = Mnp_slice.min(), Mnp_slice.max()
+    maxSize = min(LUT_MAX_SIZE, max(LUT_MIN_SIZE, LUT_PIXEL_RATIO * Mnp_slice.size))
+    if int(vmax) - int(vmin) + 1 > maxSize:
+        return None, None
+    # Unsigned slices are indexed directly when the table can start at 0,
+    # which saves subtracting the offset from every pixel; entries below
+    # vmin are never looked up.
+    offset  = int(vmin)
+    if np.issubdtype(Mnp_slice.dtype, np.unsignedinteger) and int(vmax) + 1 <= maxSize:
+        offset = 0
+    # Normalized in float64, as the float64 volumes of get_fdata() were:
+    # matplotlib would scale integer values in float32, which moves some
+    # of them to the neighbouring colormap entry.
+    values  = np.arange(offset, int(vmax) + 1).astype(np.float64)
+    sm      = cm.ScalarMappable(cmap=cmap)
+    sm.set_clim(float(vmin), float(vmax))
+    return sm.to_rgba(values, bytes=True), offset
+
+
+def lut_apply(lut, offset, Mnp_slice):
+    '''
+    Maps <Mnp_slice> through a table made by lut_build().
+    '''
+    if offset:
+        return lut[Mnp_slice.astype(np.intp) - offset]
+    return lut[Mnp_slice]
+
+
+def render(cmap, Mnp_slice, backgroundPixel=None, paint=None):
+    '''
+    Returns <Mnp_slice> colormapped with <cmap> as an (rows, cols, 4)
+    uint8 RGBA array, with the same pixels pylab.imsave would write.
+
+    With a <backgroundPixel> (row, col), pixels of the color of that
+    pixel are made transparent white, as background_remove() would.
+    When the slice goes through a table, this is decided on the table
+    entries, before any pixel is mapped.
+
+    <paint>, a (low, high, color) tuple, draws every nonzero voxel with
+    low < value < high in the opaque matplotlib color <color>.
+    '''
+    lut, offset = render_lut(cmap, Mnp_slice, backgroundPixel, paint)
+    if lut is None:
+        sm = cm.ScalarMappable(cmap=cmap)
+        sm.set_clim(float(Mnp_slice.min()), float(Mnp_slice.max()))
+        Mnp_rgba = sm.to_rgba(np.asarray(Mnp_slice, dtype=np.float64), bytes=True)
+        if backgroundPixel is not None:
+            Mnp_rgba = background_remove(Mnp_rgba, backgroundPixel)
+        if paint is not None:
+            Mnp_rgba[paint_mask(Mnp_slice, paint)] = color_bytes(paint[2])
+        return Mnp_rgba
+    return lut_apply(lut, offset, Mnp_slice)
+
+
+def render_lut(cmap, Mnp_slice, backgroundPixel=None, paint=None):
+    '''
+    The table (and offset) render() maps <Mnp_slice> through, see
+    lut_build(); (None, None) if the slice is rendered without one.
+    '''
+    lut, offset = lut_build(cmap, Mnp_slice)
+    if lut is None:
+        return None, None
+    if backgroundPixel is not None and min(Mnp_slice.shape[:2]) >= 2:
+        background  = lut[int(Mnp_slice[backgroundPixel]) - offset, :3].copy()
+        lut[(lut[:, :3] == background).all(axis=1)] = (255, 255, 255, 0)
+    if paint is not None:
+        lut[paint_mask(np.arange(offset, offset + len(lut)), paint)] = color_bytes(paint[2])
+    return lut, offset
+
+
+def render_gray(cmap, Mnp_slice, backgroundPixel=None):
+    '''
+    Renders <Mnp_slice> like render(), as a single gray channel when
+    every color of its table is a gray level that is either opaque or
+    fully transparent. Returns (Mnp_gray, key), where:
+
+      o Mnp_gray is a (rows, cols) uint8 "L" image and <key> the gray
+        level its transparent pixels are written with (None if there
+        are none), a level no opaque table entry has, so that a tRNS
+        key marks exactly them;
+      o Mnp_gray is a (rows, cols, 2) uint8 "LA" image otherwise (the
+        opaque entries use all 256 gray levels), and <key> is None;
+
+    or (None, None) if the slice has colors or no table.
+    '''
+    lut, offset = render_lut(cmap, Mnp_slice, backgroundPixel)
+    if lut is None or not ((lut[:, 0] == lut[:, 1]) & (lut[:, 1] == lut[:, 2])).all():
+        return None, None
+    gray, alpha = lut[:, 0], lut[:, 3]
+    transparent = alpha == 0
+    if ((alpha == 255) | transparent).all():
+        if not transparent.any():
+            return lut_apply(np.ascontiguousarray(gray), offset, Mnp_slice), None
+        # The key is a gray level free of opaque entries: the one the
+        # transparent entries already have (the white of
+        # background_remove) if possible, else the lowest free one,
+        # often the gray the background had before it was removed.
+        l_used      = np.zeros(PALETTE_SIZE, dtype=bool)
+        l_used[gray[~transparent]] = True
+        keys        = np.unique(gray[transparent])
+        if len(keys) == 1 and not l_used[keys[0]]:
+            key     = int(keys[0])
+        elif not l_used.all():
+            key     = int(np.flatnonzero(~l_used)[0])
+        else:
+            key     = None
+        if key is not None:
+            gray    = gray.copy()
+            gray[transparent] = key
+            return lut_apply(gray, offset, Mnp_slice), key
+    return lut_apply(np.ascontiguousarray(lut[:, [0, 3]]), offset, Mnp_slice), None
+
+
+def paint_mask(Mnp_values, paint):
+    low, high, _ = paint
+    return (Mnp_values > low) & (Mnp_values < high) & (Mnp_values != 0)
+
+
+def color_bytes(color):
+    '''
+    A matplotlib color as uint8 RGBA, rounded as colormaps round it.
+    '''
+    return (mcolors.to_rgba_array([color])[0] * 255).astype(np.uint8)
+
+
+def label_lut(l_colors):
+    '''
+    Compiles a list of label colors (label i is drawn with l_colors[i])
+    into a uint8 RGBA table, converted as matplotlib converts colormap
+    entries. One extra transparent entry at the end receives labels
+    that have no color.
+    '''
+    lut = (mcolors.to_rgba_array(l_colors) * 255).astype(np.uint8)
+    return np.concatenate([lut, np.zeros((1, 4), dtype=np.uint8)])
+
+
+def label_clip(lut, Mnp_slice):
+    '''
+    Returns the labels of <Mnp_slice> as integers, with those that have
+    no color in <lut> (a label_lut() table) replaced by its last entry.
+    '''
+    if not np.issubdtype(Mnp_slice.dtype, np.integer):
+        Mnp_slice = Mnp_slice.astype(np.intp)
+    nColors = len(lut) - 1
+    if Mnp_slice.size and (Mnp_slice.min() < 0 or Mnp_slice.max() >= nColors):
+        Mnp_slice = np.where((Mnp_slice < 0) | (Mnp_slice >= nColors), nColors, Mnp_slice)
+    return Mnp_slice
+
+
+def label_apply(lut, Mnp_slice):
+    '''
+    Maps the labels of <Mnp_slice> through a table made by label_lut().
+    '''
+    return lut[label_clip(lut, Mnp_slice)]
+
+
+def label_index(lut, Mnp_slice):
+    '''
+    Like palette_index(), for a table made by label_lut(). uint8 label
+    slices are their own palette indices; the palette is extended with
+    transparent entries up to the largest label of the slice.
+    '''
+    nColors = len(lut) - 1
+    if Mnp_slice.dtype == np.uint8 and nColors <= PALETTE_SIZE:
+        nEntries    = max(nColors, int(Mnp_slice.max()) + 1 if Mnp_slice.size else 0)
+        Mnp_palette = np.zeros((nEntries, 4), dtype=np.uint8)
+        Mnp_palette[:nColors] = lut[:nColors]
+        return Mnp_slice, Mnp_palette
+    return palette_index(lut, 0, label_clip(lut, Mnp_slice))
+
+
+def palette_index(lut, offset, Mnp_slice):
+    '''
+    Expresses <Mnp_slice> mapped through <lut> (see lut_build()) as a
+    palette image. Returns (Mnp_index, Mnp_palette): uint8 indices into
+    an RGBA palette of at most PALETTE_SIZE entries, or (None, None) if
+    the table holds more colors than that.
+    '''
+    if Mnp_slice.dtype == np.uint8 and not offset and len(lut) <= PALETTE_SIZE:
+        # the voxel values are the palette indices
+        return Mnp_slice, lut
+    Mnp_palette, Mnp_inverse = np.unique(lut, axis=0, return_inverse=True)
+    if len(Mnp_palette) > PALETTE_SIZE:
+        return None, None
+    return lut_apply(Mnp_inverse.reshape(-1).astype(np.uint8), offset, Mnp_slice), Mnp_palette
+
+
+def background_remove(Mnp_rgba, backgroundPixel=(1, 1)):
+    '''
+    Makes every pixel with the color of pixel <backgroundPixel>
+    transparent white, in place.
+    '''
+    if min(Mnp_rgba.shape[:2]) < 2:
+        return Mnp_rgba
+    background  = Mnp_rgba[backgroundPixel][:3].copy()
+    mask        = (Mnp_rgba[:, :, :3] == background).all(axis=2)
+    Mnp_rgba[mask] = (255, 255, 255, 0)
+    return Mnp_rgba
+
+
+def pil_format(fformat):
+    '''
+    The PIL format name of the output extension <fformat>.
+    '''
+    return {'jpg': 'jpeg', 'tif': 'tiff'}.get(fformat.lower(), fformat.lower())
+
+
+def rgba_image(Mnp_rgba, fformat):
+    '''
+    The PIL image of an RGBA array, to be written as <fformat>. Formats
+    without an alpha channel (e.g. jpg) get the image composited over
+    white, as pylab.imsave does.
+    '''
+    img = Image.fromarray(np.ascontiguousarray(Mnp_rgba), 'RGBA')
+    if pil_format(fformat) in ['jpeg', 'pcx', 'ppm']:
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, img)
+        img = background
+    return img
+
+
+def indexed_image(Mnp_index, Mnp_palette):
+    '''
+    The "P" mode PIL image of a palette image (see palette_index()). The
+    alpha of the palette is kept as transparency (a PNG tRNS chunk),
+    unless every entry is opaque.
+    '''
+    img = Image.fromarray(np.ascontiguousarray(Mnp_index), 'P')
+    img.putpalette(Mnp_palette[:, :3].tobytes())
+    if (Mnp_palette[:, 3] != 255).any():
+        img.info['transparency'] = Mnp_palette[:, 3].tobytes()
+    return img
+
+
+def gray_image(Mnp_gray, key):
+    '''
+    The PIL image of a gray image made by render_gray(): "L" with the
+    transparency <key>, or "LA".
+    '''
+    img = Image.fromarray(np.ascontiguousarray(Mnp_gray), 'LA' if Mnp_gray.ndim == 3 else 'L')
+    if key is not None:
+        img.info['transparency'] = key
+    return img
+
+
+def image_write(img, astr_outputFile, fformat, encoder=None):
+    '''
+    Encodes the PIL image <img> once into <astr_outputFile>, with the
+    settings of <encoder> (an encoder.Encoder; PIL defaults if None).
+    '''
+    if encoder is None:
+        img.save(astr_outputFile, pil_format(fformat))
+    else:
+        encoder.save(img, astr_outputFile, pil_format(fformat))
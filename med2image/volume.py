@@ -0,0 +1,196 @@
+# NAME
+#
+#        volume
+#
+# DESCRIPTION
+#
+#        Volume access helpers for med2image. These wrap on-disk
+#        image data so that 'dim_save' can slice a volume without
+#        having it fully resident in memory.
+#
+
+# System imports
+import collections
+import numpy as np
+
+
+class LazyVolume(object):
+    '''
+    A read-on-demand 3D view over a nibabel array proxy.
+
+    Only the voxels addressed by an index expression are read from
+    disk (for uncompressed NIfTI the proxy is memory mapped), so a
+    single slice costs slice-sized memory regardless of the volume
+    size. For 4D data, <frame> selects the 3D volume to expose.
+
+    Slices keep the voxel type the proxy yields (the on-disk type, or
+    floating point for scaled images) unless an explicit <dtype> is
+    given.
+    '''
+
+    def __init__(self, dataobj, frame=None, dtype=None):
+        self._dataobj   = dataobj
+        self._frame     = frame
+        self.shape      = tuple(dataobj.shape[:3])
+        self.ndim       = 3
+        if dtype is None:
+            # a single voxel tells us what type the proxy scales to
+            dtype       = np.asarray(dataobj[(0,) * len(dataobj.shape)]).dtype
+        self.dtype      = np.dtype(dtype)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if self._frame is not None:
+            key = key + (slice(None),) * (3 - len(key)) + (self._frame,)
+        return np.asarray(self._dataobj[key], dtype=self.dtype)
+
+    def __array__(self, dtype=None, copy=None):
+        return self[:, :, :] if dtype is None else self[:, :, :].astype(dtype)
+
+
+class ChunkedVolume(object):
+    '''
+    An out-of-core 3D volume assembled from cached bricks.
+
+    Index expressions made of integers and unit-step slices (the ones
+    'dim_save' uses to cut x, y and z slices) are answered from bricks
+    of the underlying <source> volume. Bricks are read on demand and
+    kept in an LRU cache that holds at most <memoryBudget> bytes, so
+    reslicing a volume larger than memory completes with bounded
+    resident size.
+
+    By default bricks are cubes whose edge is chosen so that one slab
+    of bricks across any axis fits in the budget; a pass along any
+    axis then reads every brick only once.
+    '''
+
+    def __init__(self, source, memoryBudget, brickShape=None):
+        self._source        = source
+        self.shape          = tuple(source.shape[:3])
+        self.ndim           = 3
+        self.dtype          = np.dtype(source.dtype)
+        self._budget        = int(memoryBudget)
+        self._b_fixedBricks = brickShape is not None
+        if brickShape is None:
+            brickShape      = self.brick_shape()
+        self._brickShape    = tuple(min(int(b), n) for b, n in zip(brickShape, self.shape))
+        self._cache         = collections.OrderedDict()
+        self._cacheBytes    = 0
+        self.bricksRead     = 0
+
+    def resize(self, memoryBudget):
+        '''
+        Empties the cache and sets its budget to <memoryBudget> bytes,
+        choosing default bricks anew for it.
+        '''
+        self._budget        = int(memoryBudget)
+        if not self._b_fixedBricks:
+            self._brickShape = tuple(min(int(b), n) for b, n in zip(self.brick_shape(), self.shape))
+        self._cache.clear()
+        self._cacheBytes    = 0
+
+    def brick_shape(self):
+        X, Y, Z     = self.shape
+        planeBytes  = max(X * Y, X * Z, Y * Z) * self.dtype.itemsize
+        edge        = max(1, self._budget // max(1, planeBytes))
+        return (edge, edge, edge)
+
+    def brick(self, index):
+        '''
+        Returns the brick at brick coordinates <index>, reading it from
+        the source if it is not cached.
+        '''
+        if index in self._cache:
+            self._cache.move_to_end(index)
+            return self._cache[index]
+        key = tuple(slice(i * b, min((i + 1) * b, n))
+                    for i, b, n in zip(index, self._brickShape, self.shape))
+        data = np.ascontiguousarray(self._source[key])
+        self.bricksRead += 1
+        self._cache[index]  = data
+        self._cacheBytes   += data.nbytes
+        while self._cacheBytes > self._budget and len(self._cache) > 1:
+            _, evicted          = self._cache.popitem(last=False)
+            self._cacheBytes   -= evicted.nbytes
+        return data
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        l_range     = []
+        l_keep      = []
+        for k, n in zip(key, self.shape):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(n)
+                if step != 1:
+                    raise IndexError('ChunkedVolume only supports unit-step slices')
+                l_range.append((start, max(start, stop)))
+                l_keep.append(True)
+            else:
+                k = int(k)
+                if k < 0:
+                    k += n
+                if not 0 <= k < n:
+                    raise IndexError('index %d is out of bounds for size %d' % (k, n))
+                l_range.append((k, k + 1))
+                l_keep.append(False)
+
+        out = np.empty([stop - start for start, stop in l_range], dtype=self.dtype)
+        l_bricks = [range(start // b, (stop - 1) // b + 1) if stop > start else range(0)
+                    for (start, stop), b in zip(l_range, self._brickShape)]
+        for bi in l_bricks[0]:
+            for bj in l_bricks[1]:
+                for bk in l_bricks[2]:
+                    data    = self.brick((bi, bj, bk))
+                    src     = []
+                    dst     = []
+                    for (start, stop), b, i in zip(l_range, self._brickShape, (bi, bj, bk)):
+                        lo  = max(start, i * b)
+                        hi  = min(stop, (i + 1) * b)
+                        src.append(slice(lo - i * b, hi - i * b))
+                        dst.append(slice(lo - start, hi - start))
+                    out[tuple(dst)] = data[tuple(src)]
+        return out[tuple(slice(None) if keep else 0 for keep in l_keep)]
+
+    def __array__(self, dtype=None, copy=None):
+        return self[:, :, :] if dtype is None else self[:, :, :].astype(dtype)
+
+
+def axis_contiguous(volume, axis, tile=(64, 8, 64)):
+    '''
+    Returns <volume> with <axis> moved to the front, laid out so that
+    every slice along <axis> can be read with unit stride.
+
+    If the slices already have a unit-stride axis (their rows are runs
+    of adjacent voxels) a view is returned. Otherwise the volume is
+    copied into a C-contiguous array block by block. A plain transpose
+    strides through memory on either the read or the write side. The
+    blocks here are long along the unit-stride axis of the source (the
+    slicing axis) and of the destination (the last axis), and short in
+    between, so both sides of each block copy stay in cache.
+    '''
+    src = np.moveaxis(volume, axis, 0)
+    if src.itemsize in [abs(stride) for stride in src.strides[1:]]:
+        return src
+    out = np.empty(src.shape, dtype=src.dtype)
+    (n0, n1, n2), (t0, t1, t2) = src.shape, tile
+    for a in range(0, n0, t0):
+        for b in range(0, n1, t1):
+            for c in range(0, n2, t2):
+                out[a:a + t0, b:b + t1, c:c + t2] = src[a:a + t0, b:b + t1, c:c + t2]
+    return out
+
+
+def slice_orient(volume, b_rot90=False, b_flip=False):
+    '''
+    Returns <volume> (a slice, or a stack of slices along its first
+    axis) rotated by 90 degrees and/or flipped top to bottom, as a view:
+    the orientation only changes strides, no voxel is copied.
+    '''
+    if b_rot90:
+        volume = np.rot90(volume, axes=(-2, -1))
+    if b_flip:
+        volume = volume[..., ::-1, :]
+    return volume
@@ -0,0 +1,78 @@
+# NAME
+#
+#        writer
+#
+# DESCRIPTION
+#
+#        Pipelined output for med2image. The rendering loop hands each
+#        rendered slice to a SliceWriter and moves on to the next slice,
+#        while a pool of threads encodes and writes the ones before it.
+#        Compression (zlib, libwebp) and file I/O release the GIL, so
+#        they run alongside the rendering of the following slices.
+#
+#        The queue is bounded: once <window> slices are waiting or being
+#        written, the rendering loop blocks until the oldest is on disk,
+#        so at most <window> rendered slices are held in memory.
+#
+
+# System imports
+import collections
+import concurrent.futures
+
+
+class SliceWriter(object):
+    '''
+    Runs output writes on <threads> threads, with at most <window>
+    (by default twice <threads>) queued or in flight.
+    '''
+
+    def __init__(self, threads, window=None):
+        self._executor      = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self._window        = window or 2 * threads
+        self._q_future      = collections.deque()
+        self._d_pending     = {}    # output file -> future of its write
+
+    def submit(self, str_outputFile, write):
+        '''
+        Queues write(), which produces <str_outputFile>, first waiting
+        for the oldest write if the queue is full. An error raised by an
+        earlier write is raised here.
+        '''
+        while len(self._q_future) >= self._window:
+            self.retire()
+        future = self._executor.submit(write)
+        self._q_future.append((str_outputFile, future))
+        self._d_pending[str_outputFile] = future
+
+    def retire(self):
+        '''
+        Waits for the oldest write.
+        '''
+        str_outputFile, future = self._q_future.popleft()
+        if self._d_pending.get(str_outputFile) is future:
+            del self._d_pending[str_outputFile]
+        future.result()
+
+    def wait(self, str_outputFile):
+        '''
+        Waits until <str_outputFile> is written, if it is queued.
+        '''
+        future = self._d_pending.get(str_outputFile)
+        if future is not None:
+            future.result()
+
+    def close(self):
+        '''
+        Waits for every queued write and stops the threads. The first
+        error raised by a write is raised here, and the writes not yet
+        started are then dropped.
+        '''
+        try:
+            while self._q_future:
+                self.retire()
+        finally:
+            for str_outputFile, future in self._q_future:
+                future.cancel()
+            self._q_future.clear()
+            self._d_pending.clear()
+            self._executor.shutdown(wait=True)
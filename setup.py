@@ -20,6 +20,7 @@ setup(
       url              =   'https://github.com/FNNDSC/med2image',
       packages         =   ['med2image'],
       install_requires =   ['nibabel', 'dicom', 'pydicom', 'numpy', 'matplotlib', 'pillow'],
+      extras_require   =   {'gzindex': ['indexed_gzip']},
       #test_suite       =   'nose.collector',
       #tests_require    =   ['nose'],
       scripts          =   ['bin/med2image'],